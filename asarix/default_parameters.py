@@ -41,6 +41,11 @@ PARAMETERS = {
         "types": [int],
         "short": '-z',
     },
+    "score_mz_tolerance_ppm": {
+        "default": None,
+        "types": [float, type(None)],
+        "help": "when scoring, keep only hits within this ppm error, must not exceed the search tolerance"
+    },
     "input": {
         "default": None,
         "types": [str, type(None)],
@@ -67,6 +72,43 @@ PARAMETERS = {
         "short": '-s',
         "skip_json": True
     },
+    "base_signatures": {
+        "default": None,
+        "types": [str, type(None)],
+        "skip_json": True,
+        "help": "existing generated signatures to extend, compounds already in them are not reacted again"
+    },
+    "min_mz": {
+        "default": None,
+        "types": [float, type(None)],
+        "help": "lowest m/z acquired, generated products without ions above it are pruned, defaults to the scan window of the input mzML files"
+    },
+    "max_mz": {
+        "default": None,
+        "types": [float, type(None)],
+        "help": "highest m/z acquired, generated products without ions below it are pruned, defaults to the scan window of the input mzML files"
+    },
+    "max_elements": {
+        "default": None,
+        "types": [str, type(None)],
+        "help": "formula of the maximum count of each element in generated products, e.g. C100H200N20O40"
+    },
+    "min_rdbe": {
+        "default": None,
+        "types": [float, type(None)],
+        "help": "generated products with fewer ring and double bond equivalents are pruned"
+    },
+    "element_ratios": {
+        "default": "none",
+        "types": [str],
+        "allowed": ["none", "common", "extended"],
+        "help": "prune generated products outside the common or extended element to carbon ratios of the seven golden rules"
+    },
+    "resolving_power": {
+        "default": None,
+        "types": [float, type(None)],
+        "help": "resolving power (m/dm) of the data, isotopologues it cannot resolve are searched as one ion at their centroid"
+    },
     "snr_cutoff": {
         "default": 2.5,
         "types": [float, int],
@@ -74,5 +116,32 @@ PARAMETERS = {
     "scan_cutoff": {
         "default": 0,
         "types": [int],
+    },
+    "max_gap": {
+        "default": 2,
+        "types": [int],
+        "help": "largest number of missing scans within a consecutive scan run"
+    },
+    "min_group_size": {
+        "default": 2,
+        "types": [int],
+        "help": "runs with fewer scans are dropped during the search"
+    },
+    "workers": {
+        "default": 1,
+        "types": [int],
+        "short": '-w',
+        "help": "number of worker processes, files are searched and compounds reacted in parallel when > 1"
+    },
+    "cache_dir": {
+        "default": "~/.asarix_cache",
+        "types": [str, type(None)],
+        "help": "directory for cached signature indices, pass an empty string to disable caching"
+    },
+    "scan_format": {
+        "default": "npz",
+        "types": [str],
+        "allowed": ["npz", "json"],
+        "help": "format of the scan search output, columnar npz or json for export"
     }
 }
\ No newline at end of file
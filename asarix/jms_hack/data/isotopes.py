@@ -0,0 +1,121 @@
+'''
+Natural isotopic compositions, from the NIST Atomic Weights and Isotopic Compositions
+for All Elements, for the isotopes with a non-zero natural abundance.
+
+Compiled into arrays per element, in order of mass number:
+    element: (mass numbers, relative atomic masses, isotopic compositions)
+
+Loaded on first use by jms.ions.get_isotope_table.
+'''
+
+isotopes = {
+    'H': ((1, 2), (1.00782503223, 2.01410177812), (0.999885, 0.000115)),
+    'He': ((3, 4), (3.0160293201, 4.00260325413), (1.34e-06, 0.99999866)),
+    'Li': ((6, 7), (6.0151228874, 7.0160034366), (0.0759, 0.9241)),
+    'Be': ((9,), (9.012183065,), (1.0,)),
+    'B': ((10, 11), (10.01293695, 11.00930536), (0.199, 0.801)),
+    'C': ((12, 13), (12.0, 13.00335483507), (0.9893, 0.0107)),
+    'N': ((14, 15), (14.00307400443, 15.00010889888), (0.99636, 0.00364)),
+    'O': ((16, 17, 18), (15.99491461957, 16.9991317565, 17.99915961286), (0.99757, 0.00038, 0.00205)),
+    'F': ((19,), (18.99840316273,), (1.0,)),
+    'Ne': ((20, 21, 22), (19.9924401762, 20.993846685, 21.991385114), (0.9048, 0.0027, 0.0925)),
+    'Na': ((23,), (22.989769282,), (1.0,)),
+    'Mg': ((24, 25, 26), (23.985041697, 24.985836976, 25.982592968), (0.7899, 0.1, 0.1101)),
+    'Al': ((27,), (26.98153853,), (1.0,)),
+    'Si': ((28, 29, 30), (27.97692653465, 28.9764946649, 29.973770136), (0.92223, 0.04685, 0.03092)),
+    'P': ((31,), (30.97376199842,), (1.0,)),
+    'S': ((32, 33, 34, 36), (31.9720711744, 32.9714589098, 33.967867004, 35.96708071), (0.9499, 0.0075, 0.0425, 0.0001)),
+    'Cl': ((35, 37), (34.968852682, 36.965902602), (0.7576, 0.2424)),
+    'Ar': ((36, 38, 40), (35.967545105, 37.96273211, 39.9623831237), (0.003336, 0.000629, 0.996035)),
+    'K': ((39, 40, 41), (38.9637064864, 39.963998166, 40.9618252579), (0.932581, 0.000117, 0.067302)),
+    'Ca': ((40, 42, 43, 44, 46, 48), (39.962590863, 41.95861783, 42.95876644, 43.95548156, 45.953689, 47.95252276), (0.96941, 0.00647, 0.00135, 0.02086, 4e-05, 0.00187)),
+    'Sc': ((45,), (44.95590828,), (1.0,)),
+    'Ti': ((46, 47, 48, 49, 50), (45.95262772, 46.95175879, 47.94794198, 48.94786568, 49.94478689), (0.0825, 0.0744, 0.7372, 0.0541, 0.0518)),
+    'V': ((50, 51), (49.94715601, 50.94395704), (0.0025, 0.9975)),
+    'Cr': ((50, 52, 53, 54), (49.94604183, 51.94050623, 52.94064815, 53.93887916), (0.04345, 0.83789, 0.09501, 0.02365)),
+    'Mn': ((55,), (54.93804391,), (1.0,)),
+    'Fe': ((54, 56, 57, 58), (53.93960899, 55.93493633, 56.93539284, 57.93327443), (0.05845, 0.91754, 0.02119, 0.00282)),
+    'Co': ((59,), (58.93319429,), (1.0,)),
+    'Ni': ((58, 60, 61, 62, 64), (57.93534241, 59.93078588, 60.93105557, 61.92834537, 63.92796682), (0.68077, 0.26223, 0.011399, 0.036346, 0.009255)),
+    'Cu': ((63, 65), (62.92959772, 64.9277897), (0.6915, 0.3085)),
+    'Zn': ((64, 66, 67, 68, 70), (63.92914201, 65.92603381, 66.92712775, 67.92484455, 69.9253192), (0.4917, 0.2773, 0.0404, 0.1845, 0.0061)),
+    'Ga': ((69, 71), (68.9255735, 70.92470258), (0.60108, 0.39892)),
+    'Ge': ((70, 72, 73, 74, 76), (69.92424875, 71.922075826, 72.923458956, 73.921177761, 75.921402726), (0.2057, 0.2745, 0.0775, 0.365, 0.0773)),
+    'As': ((75,), (74.92159457,), (1.0,)),
+    'Se': ((74, 76, 77, 78, 80, 82), (73.922475934, 75.919213704, 76.919914154, 77.91730928, 79.9165218, 81.9166995), (0.0089, 0.0937, 0.0763, 0.2377, 0.4961, 0.0873)),
+    'Br': ((79, 81), (78.9183376, 80.9162897), (0.5069, 0.4931)),
+    'Kr': ((78, 80, 82, 83, 84, 86), (77.92036494, 79.91637808, 81.91348273, 82.91412716, 83.9114977282, 85.9106106269), (0.00355, 0.02286, 0.11593, 0.115, 0.56987, 0.17279)),
+    'Rb': ((85, 87), (84.9117897379, 86.909180531), (0.7217, 0.2783)),
+    'Sr': ((84, 86, 87, 88), (83.9134191, 85.9092606, 86.9088775, 87.9056125), (0.0056, 0.0986, 0.07, 0.8258)),
+    'Y': ((89,), (88.9058403,), (1.0,)),
+    'Zr': ((90, 91, 92, 94, 96), (89.9046977, 90.9056396, 91.9050347, 93.9063108, 95.9082714), (0.5145, 0.1122, 0.1715, 0.1738, 0.028)),
+    'Nb': ((93,), (92.906373,), (1.0,)),
+    'Mo': ((92, 94, 95, 96, 97, 98, 100), (91.90680796, 93.9050849, 94.90583877, 95.90467612, 96.90601812, 97.90540482, 99.9074718), (0.1453, 0.0915, 0.1584, 0.1667, 0.096, 0.2439, 0.0982)),
+    'Tc': ((98,), (97.9072124,), (1.0,)),
+    'Ru': ((96, 98, 99, 100, 101, 102, 104), (95.90759025, 97.9052868, 98.9059341, 99.9042143, 100.9055769, 101.9043441, 103.9054275), (0.0554, 0.0187, 0.1276, 0.126, 0.1706, 0.3155, 0.1862)),
+    'Rh': ((103,), (102.905498,), (1.0,)),
+    'Pd': ((102, 104, 105, 106, 108, 110), (101.9056022, 103.9040305, 104.9050796, 105.9034804, 107.9038916, 109.9051722), (0.0102, 0.1114, 0.2233, 0.2733, 0.2646, 0.1172)),
+    'Ag': ((107, 109), (106.9050916, 108.9047553), (0.51839, 0.48161)),
+    'Cd': ((106, 108, 110, 111, 112, 113, 114, 116), (105.9064599, 107.9041834, 109.90300661, 110.90418287, 111.90276287, 112.90440813, 113.90336509, 115.90476315), (0.0125, 0.0089, 0.1249, 0.128, 0.2413, 0.1222, 0.2873, 0.0749)),
+    'In': ((113, 115), (112.90406184, 114.903878776), (0.0429, 0.9571)),
+    'Sn': ((112, 114, 115, 116, 117, 118, 119, 120, 122, 124), (111.90482387, 113.9027827, 114.903344699, 115.9017428, 116.90295398, 117.90160657, 118.90331117, 119.90220163, 121.9034438, 123.9052766), (0.0097, 0.0066, 0.0034, 0.1454, 0.0768, 0.2422, 0.0859, 0.3258, 0.0463, 0.0579)),
+    'Sb': ((121, 123), (120.903812, 122.9042132), (0.5721, 0.4279)),
+    'Te': ((120, 122, 123, 124, 125, 126, 128, 130), (119.9040593, 121.9030435, 122.9042698, 123.9028171, 124.9044299, 125.9033109, 127.90446128, 129.906222748), (0.0009, 0.0255, 0.0089, 0.0474, 0.0707, 0.1884, 0.3174, 0.3408)),
+    'I': ((127,), (126.9044719,), (1.0,)),
+    'Xe': ((124, 126, 128, 129, 130, 131, 132, 134, 136), (123.905892, 125.9042983, 127.903531, 128.9047808611, 129.903509349, 130.90508406, 131.9041550856, 133.90539466, 135.907214484), (0.000952, 0.00089, 0.019102, 0.264006, 0.04071, 0.212324, 0.269086, 0.104357, 0.088573)),
+    'Cs': ((133,), (132.905451961,), (1.0,)),
+    'Ba': ((130, 132, 134, 135, 136, 137, 138), (129.9063207, 131.9050611, 133.90450818, 134.90568838, 135.90457573, 136.90582714, 137.905247), (0.00106, 0.00101, 0.02417, 0.06592, 0.07854, 0.11232, 0.71698)),
+    'La': ((138, 139), (137.9071149, 138.9063563), (0.0008881, 0.9991119)),
+    'Ce': ((136, 138, 140, 142), (135.90712921, 137.905991, 139.9054431, 141.9092504), (0.00185, 0.00251, 0.8845, 0.11114)),
+    'Pr': ((141,), (140.9076576,), (1.0,)),
+    'Nd': ((142, 143, 144, 145, 146, 148, 150), (141.907729, 142.90982, 143.910093, 144.9125793, 145.9131226, 147.9168993, 149.9209022), (0.27152, 0.12174, 0.23798, 0.08293, 0.17189, 0.05756, 0.05638)),
+    'Pm': ((145,), (144.9127559,), (1.0,)),
+    'Sm': ((144, 147, 148, 149, 150, 152, 154), (143.9120065, 146.9149044, 147.9148292, 148.9171921, 149.9172829, 151.9197397, 153.9222169), (0.0307, 0.1499, 0.1124, 0.1382, 0.0738, 0.2675, 0.2275)),
+    'Eu': ((151, 153), (150.9198578, 152.921238), (0.4781, 0.5219)),
+    'Gd': ((152, 154, 155, 156, 157, 158, 160), (151.9197995, 153.9208741, 154.9226305, 155.9221312, 156.9239686, 157.9241123, 159.9270624), (0.002, 0.0218, 0.148, 0.2047, 0.1565, 0.2484, 0.2186)),
+    'Tb': ((159,), (158.9253547,), (1.0,)),
+    'Dy': ((156, 158, 160, 161, 162, 163, 164), (155.9242847, 157.9244159, 159.9252046, 160.9269405, 161.9268056, 162.9287383, 163.9291819), (0.00056, 0.00095, 0.02329, 0.18889, 0.25475, 0.24896, 0.2826)),
+    'Ho': ((165,), (164.9303288,), (1.0,)),
+    'Er': ((162, 164, 166, 167, 168, 170), (161.9287884, 163.9292088, 165.9302995, 166.9320546, 167.9323767, 169.9354702), (0.00139, 0.01601, 0.33503, 0.22869, 0.26978, 0.1491)),
+    'Tm': ((169,), (168.9342179,), (1.0,)),
+    'Yb': ((168, 170, 171, 172, 173, 174, 176), (167.9338896, 169.9347664, 170.9363302, 171.9363859, 172.9382151, 173.9388664, 175.9425764), (0.00123, 0.02982, 0.1409, 0.2168, 0.16103, 0.32026, 0.12996)),
+    'Lu': ((175, 176), (174.9407752, 175.9426897), (0.97401, 0.02599)),
+    'Hf': ((174, 176, 177, 178, 179, 180), (173.9400461, 175.9414076, 176.9432277, 177.9437058, 178.9458232, 179.946557), (0.0016, 0.0526, 0.186, 0.2728, 0.1362, 0.3508)),
+    'Ta': ((180, 181), (179.9474648, 180.9479958), (0.0001201, 0.9998799)),
+    'W': ((180, 182, 183, 184, 186), (179.9467108, 181.94820394, 182.95022275, 183.95093092, 185.9543628), (0.0012, 0.265, 0.1431, 0.3064, 0.2843)),
+    'Re': ((185, 187), (184.9529545, 186.9557501), (0.374, 0.626)),
+    'Os': ((184, 186, 187, 188, 189, 190, 192), (183.9524885, 185.953835, 186.9557474, 187.9558352, 188.9581442, 189.9584437, 191.961477), (0.0002, 0.0159, 0.0196, 0.1324, 0.1615, 0.2626, 0.4078)),
+    'Ir': ((191, 193), (190.9605893, 192.9629216), (0.373, 0.627)),
+    'Pt': ((190, 192, 194, 195, 196, 198), (189.9599297, 191.9610387, 193.9626809, 194.9647917, 195.96495209, 197.9678949), (0.00012, 0.00782, 0.3286, 0.3378, 0.2521, 0.07356)),
+    'Au': ((197,), (196.96656879,), (1.0,)),
+    'Hg': ((196, 198, 199, 200, 201, 202, 204), (195.9658326, 197.9667686, 198.96828064, 199.96832659, 200.97030284, 201.9706434, 203.97349398), (0.0015, 0.0997, 0.1687, 0.231, 0.1318, 0.2986, 0.0687)),
+    'Tl': ((203, 205), (202.9723446, 204.9744278), (0.2952, 0.7048)),
+    'Pb': ((204, 206, 207, 208), (203.973044, 205.9744657, 206.9758973, 207.9766525), (0.014, 0.241, 0.221, 0.524)),
+    'Bi': ((209,), (208.9803991,), (1.0,)),
+    'Po': ((209,), (208.9824308,), (1.0,)),
+    'At': ((210,), (209.9871479,), (1.0,)),
+    'Rn': ((222,), (222.0175782,), (1.0,)),
+    'Fr': ((223,), (223.019736,), (1.0,)),
+    'Ra': ((226,), (226.0254103,), (1.0,)),
+    'Ac': ((227,), (227.0277523,), (1.0,)),
+    'Th': ((232,), (232.0380558,), (1.0,)),
+    'Pa': ((231,), (231.0358842,), (1.0,)),
+    'U': ((234, 235, 238), (234.0409523, 235.0439301, 238.0507884), (5.4e-05, 0.007204, 0.992742)),
+    'Np': ((237,), (237.0481736,), (1.0,)),
+    'Pu': ((244,), (244.0642053,), (1.0,)),
+    'Am': ((243,), (243.0613813,), (1.0,)),
+    'Cm': ((247,), (247.0703541,), (1.0,)),
+    'Bk': ((247,), (247.0703073,), (1.0,)),
+    'Cf': ((251,), (251.0795886,), (1.0,)),
+    'Es': ((252,), (252.08298,), (1.0,)),
+    'Fm': ((257,), (257.0951061,), (1.0,)),
+    'Md': ((258,), (258.0984315,), (1.0,)),
+    'No': ((259,), (259.10103,), (1.0,)),
+    'Lr': ((262,), (262.10961,), (1.0,)),
+    'Rf': ((267,), (267.12179,), (1.0,)),
+    'Db': ((268,), (268.12567,), (1.0,)),
+    'Sg': ((271,), (271.13393,), (1.0,)),
+    'Bh': ((272,), (272.13826,), (1.0,)),
+    'Hs': ((270,), (270.13429,), (1.0,)),
+    'Mt': ((276,), (276.15159,), (1.0,)),
+}
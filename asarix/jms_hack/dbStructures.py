@@ -4,6 +4,9 @@ and to connect experimental data to empirical compounds.
 '''
 
 import json
+import os
+import pickle
+from functools import partial
 from operator import itemgetter
 import numpy as np
 import tqdm
@@ -16,7 +19,7 @@ from khipu.utils import adduct_search_patterns, \
 
 from .search import *
 from .formula import *
-from .ions import compute_adducts_formulae, generate_ion_signature
+from .ions import compute_adducts_formulae, generate_ion_signature, isotopologue_cache, prewarm_isotopologue_cache
 from .data.list_formula_mass import list_formula_mass
 
 
@@ -51,6 +54,113 @@ def annotate_peaks_against_kcds(list_peaks,
     EED.export_annotations(KCD, export_file_name_prefix)
 
 
+#----------------------------------------------------------------------------------------
+class IonTable:
+    '''
+    The ions of a knownCompoundDatabase stored as parallel numpy arrays, sorted by mode then m/z:
+        mz - float64, m/z of the ion (neutral mass for mode 'neutral')
+        parent - int32, index into parents, the emp_cpd the ion is generated from
+        relation - int32, index into relations, the ion_relation string, e.g. 'M+H[1+]'
+        order - int16, isotopologue order, 0 for the monoisotopic ion
+        mode - int8, index into MODES
+    parents is the list of emp_cpds (values of mass_indexed_compounds) and relations the list of
+    distinct ion_relation strings; these are shared by all ions instead of copied into each.
+
+    Ions are materialized as dicts only when returned from a search, see ion.
+    The arrays can be saved as .npy files and memory-mapped, see save and load.
+    '''
+    MODES = ('neutral', 'pos', 'neg')
+    FIELDS = {'mz': np.float64, 'parent': np.int32, 'relation': np.int32, 'order': np.int16, 'mode': np.int8}
+
+    def __init__(self, parents, relations, columns):
+        '''
+        parents: list of emp_cpds, relations: list of ion_relation strings, 
+        columns: dict of arrays for FIELDS, sorted by mode then mz.
+        '''
+        self.parents = parents
+        self.relations = relations
+        self.mz = columns['mz']
+        self.parent = columns['parent']
+        self.relation = columns['relation']
+        self.order = columns['order']
+        self.mode = columns['mode']
+        bounds = np.searchsorted(self.mode, np.arange(len(self.MODES) + 1))
+        self.mode_bounds = {m: (int(bounds[i]), int(bounds[i+1])) for i, m in enumerate(self.MODES)}
+
+    def __len__(self):
+        return self.mz.shape[0]
+
+    @classmethod
+    def from_ions(cls, parents, ions):
+        '''
+        Build the table from an iterable of ions as (mz, parent index, ion_relation, order, mode).
+        '''
+        relation_codes = {}
+        columns = {field: [] for field in cls.FIELDS}
+        mode_codes = {m: i for i, m in enumerate(cls.MODES)}
+        for mz, parent, ion_relation, order, mode in ions:
+            columns['mz'].append(mz)
+            columns['parent'].append(parent)
+            columns['relation'].append(relation_codes.setdefault(ion_relation, len(relation_codes)))
+            columns['order'].append(order)
+            columns['mode'].append(mode_codes[mode])
+        columns = {field: np.array(v, dtype=cls.FIELDS[field]) for field, v in columns.items()}
+        sort_order = np.lexsort((columns['mz'], columns['mode']))
+        return cls(parents, list(relation_codes), {field: v[sort_order] for field, v in columns.items()})
+
+    def mz_array(self, mode):
+        '''
+        Return the sorted m/z values of the ions in mode, a view into self.mz.
+        '''
+        start, end = self.mode_bounds[mode]
+        return self.mz[start:end]
+
+    def search(self, query_mzs, mode='pos', mz_tolerance_ppm=5):
+        '''
+        Return (query_indices, rows) for all ions of mode within mz_tolerance_ppm of query_mzs, 
+        where rows index the table, see find_all_matches_sorted_mz_index.
+        '''
+        start, end = self.mode_bounds[mode]
+        query_indices, matched_indices = find_all_matches_sorted_mz_index(query_mzs, self.mz[start:end], mz_tolerance_ppm)
+        return query_indices, matched_indices + start
+
+    def ion(self, row):
+        '''
+        Materialize the ion at row as a dict, the emp_cpd fields plus the ion's own, e.g.
+            {'interim_id': 'C4H3FN2O2_130.017856', ..., 'mz': 131.025, 'parent_epd_id': 'C4H3FN2O2_130.017856', 
+            'ion_relation': 'M+H[1+]', 'order': 0}
+        '''
+        parent = self.parents[self.parent[row]]
+        ion = dict(parent)
+        ion['mz'] = float(self.mz[row])
+        ion['parent_epd_id'] = parent['interim_id']
+        ion['ion_relation'] = self.relations[self.relation[row]]
+        ion['order'] = int(self.order[row])
+        return ion
+
+    def ion_key(self, row):
+        '''
+        Return interim_id$ion_relation for the ion at row, without materializing it.
+        '''
+        return self.parents[self.parent[row]]['interim_id'] + '$' + self.relations[self.relation[row]]
+
+    def save(self, index_dir):
+        '''
+        Save the arrays to index_dir as .npy files; parents and relations are left to the caller.
+        '''
+        for field in self.FIELDS:
+            np.save(os.path.join(index_dir, 'ions_' + field + '.npy'), getattr(self, field))
+
+    @classmethod
+    def load(cls, index_dir, parents, relations, mmap_mode='r'):
+        '''
+        Load the arrays written by save, memory-mapped unless mmap_mode is None.
+        '''
+        return cls(parents, relations, {
+            field: np.load(os.path.join(index_dir, 'ions_' + field + '.npy'), mmap_mode=mmap_mode) for field in cls.FIELDS
+        })
+
+
 #----------------------------------------------------------------------------------------
 class knownCompoundDatabase:
     '''
@@ -60,21 +170,21 @@ class knownCompoundDatabase:
     which often include isomers. The regular mass search cannot distinguish isomers.
 
     One can search by mass or mass tree (patterns of isotopes/adducts, in the form of empCpd.
-    We use build_centurion_tree to index empCpds;
-    centurion_mass_tree is an indexed dictionary to group ions by 100th decimal.
+    The ions of all empCpds are indexed in an IonTable, sorted by m/z.
     There are situations where only neutral mass is searched; others requiring ionized forms.
-    This class generates three trees to accommodate them: 'neutral', 'pos' and 'neg'.
+    The table holds three modes to accommodate them: 'neutral', 'pos' and 'neg'.
     '''
     def __init__(self):
         '''
-        Two main data containers, mass_indexed_compounds and emp_cpds_trees.
-        The latter is indexed for searches, separately for positive and negative ion modes.
+        Two main data containers, mass_indexed_compounds and ion_table.
+        The latter is indexed for searches, separately for neutral, positive and negative ion modes.
+        emp_cpds_mz_occupancy marks the centurion bins that can match an ion within occupancy_ppm,
+        to discard most query m/z values before the exact search.
         '''
         self.mass_indexed_compounds = {}
-        self.emp_cpds_trees = { 'pos': {}, 
-                                'neg': {},
-                                'neutral': {},
-                                }
+        self.ion_table = IonTable.from_ions([], [])
+        self.emp_cpds_mz_occupancy = {}
+        self.occupancy_ppm = 0
         
     def mass_index_list_compounds(self, list_compounds):
         '''
@@ -116,16 +226,19 @@ class knownCompoundDatabase:
                 "compounds": v
             }
 
-    def build_emp_cpds_index(self, primary_only=True, include_C13=True):
+    def build_emp_cpds_index(self, primary_only=True, include_C13=True, occupancy_ppm=50, resolving_power=None):
         '''
         For each emp_cpd, generate ion signatures common_adducts adducts (pos or neg ion mode).
-        Then use build_centurion_tree function from .search to build index.
+        Then index them in an IonTable, which holds one row per ion rather than a dict copy of the emp_cpd.
 
         primary_only: only considering the most common ions 
         (https://github.com/shuzhao-li/mass2chem/blob/master/mass2chem/formula.py),
         which are adequate for initial search and annoation. 
         One may choose to extend the search for other ions after the emp_cpd is matched.
 
+        occupancy_ppm: the widest search tolerance served by the occupancy prefilter, 
+        see build_mz_occupancy_index. Wider searches skip the prefilter.
+
         include_C13: considering 13C isotopes for the adducts.
         This is not desired in default application of matching to experimental data via empCpds.
         The isotopes and adducts should be organized into empCpds in experimental data,
@@ -133,45 +246,119 @@ class knownCompoundDatabase:
         In that scenario, adding 13C in DB records is unecessary.
         One should include 13C when generating a database for single ion searches.
 
-        Format example -
-        pos_peak_list: [{'parent_epd_id': 1670, 'mz': 133.0970237, 'ion_relation': 'M[1+]'}, ...]
+        resolving_power: with include_C13, isotopologues not resolved at this resolving power are 
+        merged into one ion, see generate_ion_signature. None keeps every fine structure isotopologue.
+
+        Format example, as materialized by IonTable.ion -
+        {'parent_epd_id': 1670, 'mz': 133.0970237, 'ion_relation': 'M[1+]', 'order': 0, ...}
 
         '''
         __ion_generator__ = compute_adducts_formulae
         if include_C13:
-            __ion_generator__ = generate_ion_signature
+            __ion_generator__ = partial(generate_ion_signature, resolving_power=resolving_power)
         
-        peak_lists = {"pos": [], "neg": [], "neutral": []}
-        for k, v in tqdm.tqdm(self.mass_indexed_compounds.items()):
-            peak = {a: b for a, b in v.items()}
-            peak['mz'] = v['neutral_formula_mass']
-            peak['parent_epd_id'] = k
-            peak['ion_relation'] = 'neutral'
-            peak_lists['neutral'].append(peak)
-            for mode in ["pos", "neg"]:
-                for ion in __ion_generator__(v['neutral_formula_mass'], v['neutral_formula'], mode=mode, primary_only=primary_only):
-                    ion_peak = dict(peak)
-                    ion_peak['mz'] = ion[0]
-                    ion_peak['ion_relation'] = ion[1]
-                    if "order" in ion:
-                        ion_peak["order"]: ion[3]
-                    peak_lists[mode].append(ion_peak)
-        self.emp_cpds_trees = {k: build_centurion_tree(v) for k, v in peak_lists.items()}
+        # isotopologues are computed in batches of parents ahead of their ions, small enough to stay in the cache
+        batch_size = isotopologue_cache.maxsize // 2
+
+        def __iter_ions__():
+            for i, v in enumerate(tqdm.tqdm(parents)):
+                if include_C13 and i % batch_size == 0:
+                    prewarm_isotopologue_cache([p['neutral_formula'] for p in parents[i:i + batch_size]])
+                yield v['neutral_formula_mass'], i, 'neutral', 0, 'neutral'
+                for mode in ["pos", "neg"]:
+                    for ion in __ion_generator__(v['neutral_formula_mass'], v['neutral_formula'], mode=mode, primary_only=primary_only):
+                        # compute_adducts_formulae gives [mz, ion_relation, formula], generate_ion_signature adds the order
+                        yield ion[0], i, ion[1], ion[3] if len(ion) > 3 else 0, mode
+
+        parents = list(self.mass_indexed_compounds.values())
+        self.ion_table = IonTable.from_ions(parents, __iter_ions__())
+        self.build_mz_occupancy_index(occupancy_ppm)
+
+    def build_mz_occupancy_index(self, occupancy_ppm=50):
+        '''
+        Build emp_cpds_mz_occupancy from ion_table, a boolean array per mode over int(mz*100) bins,
+        dilated to cover occupancy_ppm around each ion. It is cheap to build thus not saved with the index.
+        '''
+        self.occupancy_ppm = occupancy_ppm
+        self.emp_cpds_mz_occupancy = {
+            mode: build_mz_occupancy(self.ion_table.mz_array(mode), occupancy_ppm) for mode in IonTable.MODES
+        }
+
+    def save_index(self, index_dir):
+        '''
+        Save the compiled index to index_dir, to be reloaded by load_index without regenerating ions.
+        The ion table arrays are written as .npy files so that they can be memory-mapped;
+        compounds and the ion_relation strings are pickled.
+        '''
+        os.makedirs(index_dir, exist_ok=True)
+        self.ion_table.save(index_dir)
+        with open(os.path.join(index_dir, 'index.pickle'), 'wb') as O:
+            pickle.dump({
+                'mass_indexed_compounds': self.mass_indexed_compounds,
+                'relations': self.ion_table.relations,
+            }, O, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_index(self, index_dir, mmap_mode='r', occupancy_ppm=50):
+        '''
+        Load an index written by save_index, replacing mass_indexed_compounds and the search indices.
+        mmap_mode is passed to numpy.load for the ion table arrays; None reads them fully into memory.
+        occupancy_ppm is passed to build_mz_occupancy_index.
+        '''
+        with open(os.path.join(index_dir, 'index.pickle'), 'rb') as O:
+            saved = pickle.load(O)
+        self.mass_indexed_compounds = saved['mass_indexed_compounds']
+        self.ion_table = IonTable.load(index_dir, 
+                                       list(self.mass_indexed_compounds.values()), 
+                                       saved['relations'], 
+                                       mmap_mode=mmap_mode)
+        self.build_mz_occupancy_index(occupancy_ppm)
 
     def search_mz_single(self, query_mz, mode='pos', mz_tolerance_ppm=5):
         '''
         return list of matched empCpds, e.g.
             [{'mz': 130.017306555, 'parent_epd_id': 'C4H3FN2O2_130.017856', 'ion_relation': 'M[1+]'}]
         '''
-        return find_all_matches_centurion_indexed_list(query_mz, self.emp_cpds_trees[mode], mz_tolerance_ppm)
+        if mz_tolerance_ppm <= self.occupancy_ppm:
+            occupancy, _bin = self.emp_cpds_mz_occupancy[mode], int(query_mz * 100)
+            if not (0 <= _bin < occupancy.shape[0] and occupancy[_bin]):
+                return []
+        _, rows = self.ion_table.search([query_mz], mode, mz_tolerance_ppm)
+        return [self.ion_table.ion(row) for row in rows.tolist()]
+
+    def search_mz_spectrum(self, query_mz_array, mode='pos', mz_tolerance_ppm=5):
+        '''
+        Search all m/z values of a spectrum in one vectorized join against ion_table.
+        Return (query_indices, ion_indices), where ion_indices are rows of self.ion_table, e.g.
+            (array([0, 3, 3]), array([17, 52, 53]))
+        Peaks outside the occupied bins of emp_cpds_mz_occupancy are masked out first, 
+        unless mz_tolerance_ppm is wider than occupancy_ppm.
+        '''
+        if mz_tolerance_ppm > self.occupancy_ppm:
+            return self.ion_table.search(query_mz_array, mode, mz_tolerance_ppm)
+        query_mz_array = np.asarray(query_mz_array, dtype=np.float64)
+        candidates = np.flatnonzero(mz_occupied(query_mz_array, self.emp_cpds_mz_occupancy[mode]))
+        query_indices, ion_indices = self.ion_table.search(query_mz_array[candidates], mode, mz_tolerance_ppm)
+        return candidates[query_indices], ion_indices
+
+    def search_mz_batch_csr(self, query_mzs, mode='pos', mz_tolerance_ppm=5):
+        '''
+        Search an array of m/z values in one join against ion_table.
+        Return (offsets, ion_indices, ppm_errors) in CSR form: the matches of query_mzs[i] are
+        rows ion_indices[offsets[i]:offsets[i+1]] of self.ion_table, see matches_to_csr.
+        '''
+        query_mzs = np.asarray(query_mzs, dtype=np.float64)
+        query_indices, ion_indices = self.search_mz_spectrum(query_mzs, mode, mz_tolerance_ppm)
+        return matches_to_csr(query_indices, ion_indices, query_mzs, self.ion_table.mz)
 
     def search_mz_batch(self, query_mz_list, mode='pos', mz_tolerance_ppm=5):
-        results = []
-        for query_mz in query_mz_list:
-            results.append(
-                self.search_mz_single(query_mz, mode, mz_tolerance_ppm)
-            )
-        return results
+        '''
+        return a list of matched empCpds for each of query_mz_list, as search_mz_single; 
+        a wrapper of search_mz_batch_csr.
+        '''
+        offsets, ion_indices, _ = self.search_mz_batch_csr(query_mz_list, mode, mz_tolerance_ppm)
+        offsets, ion_indices = offsets.tolist(), ion_indices.tolist()
+        return [[self.ion_table.ion(row) for row in ion_indices[offsets[i]:offsets[i+1]]] 
+                for i in range(len(offsets) - 1)]
 
     def evaluate_mass_accuracy_ratio(self, query_mz_list, mode='pos', mz_tolerance_ppm=10):
         '''
@@ -179,11 +366,13 @@ class knownCompoundDatabase:
         then evaluate systematic shift of experimental m/z values by theoretical compound values.
         This can be used to report mass accuracy, and to help mass calibration.
         '''
-        results = []        # delta m/z, [(expt - theoretical)/theoretical, ...]
-        for query_mz in query_mz_list:
-            found = find_best_match_centurion_indexed_list(query_mz, self.emp_cpds_trees[mode], mz_tolerance_ppm)
-            if found:
-                results.append( query_mz/found['mz'] - 1 )
+        # delta m/z, [(expt - theoretical)/theoretical, ...], using the closest match of each query
+        query_mzs = np.asarray(query_mz_list, dtype=np.float64)
+        query_indices, rows = self.ion_table.search(query_mzs, mode, mz_tolerance_ppm)
+        ion_mzs = self.ion_table.mz[rows]
+        best = np.lexsort((np.abs(ion_mzs - query_mzs[query_indices]), query_indices))
+        best = best[np.r_[True, query_indices[best][1:] != query_indices[best][:-1]]] if best.size else best
+        results = (query_mzs[query_indices[best]] / ion_mzs[best] - 1).tolist()
 
         if results:
             ratio = np.mean(results)
@@ -208,7 +397,7 @@ class knownCompoundDatabase:
 
         If input emp_cpd is generated from khipu, neutral_formula_mass is usually alrady assigned, 
         and this is simple search on neutral_formula_mass.
-        Otherwise, anchor ion is searched in emp_cpds_trees (from mass_indexed_compounds).
+        Otherwise, anchor ion is searched in ion_table (from mass_indexed_compounds).
         The ion_relations are expected to be ['M[1+]', 'M+H[1+]', 'M+Na[1+]', 'M+H2O+H[1+]'] for pos,
         and ['M[-]', 'M-H[-]', 'M-H2O-H[-]', 'M+Cl[-]'] for neg.
 
@@ -294,6 +483,8 @@ class ExperimentalEcpdDatabase:
         self.dict_peaks = {}
         self.dict_empCpds = {}
         self.indexed_empCpds = {}
+        self.peaks_mz_index = build_sorted_mz_index([])
+        self.empCpds_mz_index = build_sorted_mz_index([])
         self.peak_to_empCpd = {}
         self.peak_to_empCpd_ion_relation = {}
 
@@ -378,7 +569,8 @@ class ExperimentalEcpdDatabase:
 
         Updates
         -------
-        self.indexed_peaks, self.formula_tree, self.indexed_empCpds
+        self.indexed_peaks, self.formula_tree, self.indexed_empCpds,
+        and their sorted array counterparts self.peaks_mz_index, self.empCpds_mz_index for batch searches
         '''
         for P in self.list_peaks:
             self.dict_peaks[P['id_number']] = P
@@ -397,6 +589,8 @@ class ExperimentalEcpdDatabase:
                 __PL.append( P )
 
         self.indexed_empCpds = build_centurion_tree(__PL)
+        self.peaks_mz_index = build_sorted_mz_index(self.list_peaks)
+        self.empCpds_mz_index = build_sorted_mz_index(__PL)
 
     # standalone search functions
     def search_peaks_mz_single(self, query_mz, mz_tolerance_ppm=5):
@@ -405,13 +599,19 @@ class ExperimentalEcpdDatabase:
         '''
         return find_all_matches_centurion_indexed_list(query_mz, self.indexed_peaks, mz_tolerance_ppm)
 
+    def search_peaks_mz_batch_csr(self, query_mzs, mz_tolerance_ppm=5):
+        '''
+        Search an array of m/z values in one join against the peaks.
+        Return (offsets, peak_indices, ppm_errors) in CSR form, where peak_indices point into 
+        the m/z sorted peaks self.peaks_mz_index[1], see matches_to_csr.
+        '''
+        return find_all_matches_sorted_mz_index_csr(query_mzs, self.peaks_mz_index[0], mz_tolerance_ppm)
+
     def search_peaks_mz_batch(self, query_mz_list, mz_tolerance_ppm=5):
-        results = []
-        for query_mz in query_mz_list:
-            results.append(
-                self.search_peaks_mz_single(query_mz, mz_tolerance_ppm)
-            )
-        return results
+        '''
+        return a list of matched peaks for each of query_mz_list; a wrapper of search_peaks_mz_batch_csr.
+        '''
+        return csr_to_lists(*self.search_peaks_mz_batch_csr(query_mz_list, mz_tolerance_ppm)[:2], self.peaks_mz_index[1])
 
     def search_empCpds_mz_single(self, query_mz, mz_tolerance_ppm=5):
         '''
@@ -419,13 +619,19 @@ class ExperimentalEcpdDatabase:
         '''
         return find_all_matches_centurion_indexed_list(query_mz, self.indexed_empCpds, mz_tolerance_ppm)
 
+    def search_empCpds_mz_batch_csr(self, query_mzs, mz_tolerance_ppm=5):
+        '''
+        Search an array of m/z values in one join against the peaks of empCpds.
+        Return (offsets, peak_indices, ppm_errors) in CSR form, where peak_indices point into 
+        the m/z sorted empCpd peaks self.empCpds_mz_index[1], see matches_to_csr.
+        '''
+        return find_all_matches_sorted_mz_index_csr(query_mzs, self.empCpds_mz_index[0], mz_tolerance_ppm)
+
     def search_empCpds_mz_batch(self, query_mz_list, mz_tolerance_ppm=5):
-        results = []
-        for query_mz in query_mz_list:
-            results.append(
-                self.search_empCpds_mz_single(query_mz, mz_tolerance_ppm)
-            )
-        return results
+        '''
+        return a list of matched empCpds for each of query_mz_list; a wrapper of search_empCpds_mz_batch_csr.
+        '''
+        return csr_to_lists(*self.search_empCpds_mz_batch_csr(query_mz_list, mz_tolerance_ppm)[:2], self.empCpds_mz_index[1])
 
     def search_peaks_compound_single(self, compound, mz_tolerance_ppm=5):
         '''
@@ -18,9 +18,11 @@ from khipu.utils import adduct_search_patterns, \
 
 from mass2chem.formula import compute_adducts_formulae
 from mass2chem.formula import parse_chemformula_dict
-import json
+import os
+import re
 import heapq
-from scipy.stats import multinomial
+import pickle
+from collections import OrderedDict
 import numpy as np
 import itertools
 from copy import deepcopy
@@ -44,147 +46,292 @@ dev_isotopic_patterns = [
 # -----------------------------------------------------------------------------
 #
 
-isotope_information = json.load(open("/Users/mitchjo/Projects/xasari/NIST_isotope_data.json"))
-
-element_to_iso = {}
-for iso_dict in isotope_information:
-    if iso_dict["Atomic Symbol"] == "D":
-        iso_dict["Atomic Symbol"] = "H"
-    if iso_dict["Atomic Symbol"] not in element_to_iso:
-        element_to_iso[iso_dict["Atomic Symbol"]] = []
-    element_to_iso[iso_dict["Atomic Symbol"]].append(iso_dict)
-
-element_to_iso_tuples = {}
-for element, isotopes in element_to_iso.items():
-    iso_NAPs, iso_masses = [], []
-    for iso in isotopes:
-        iso_symbol = iso["Atomic Symbol"] + str(iso["Mass Number"])
-        mass = iso["Relative Atomic Mass"]
-        NAP = iso['Isotopic Composition']
-        if NAP and NAP > .005:
-            iso_NAPs.append((iso_symbol, NAP, mass))
-    iso_NAPs = sorted(iso_NAPs, key=lambda x: -x[1])
-    if iso["Atomic Symbol"] == "Sn" or iso["Atomic Symbol"] == "Os":
-        iso_NAPs = iso_NAPs[:2]
-    if iso_NAPs:
-        element_to_iso_tuples[element] = iso_NAPs
-
-multi_cache = {}
-element_prob_vectors = {}
-def calc_prob(iso_coord):
-    sub_coord_probs = []
-    for element, sub_coord in iso_coord.items():
-        key_tuple = (element, tuple(sub_coord))
-        if key_tuple in multi_cache:
-            sub_coord_probs.append(multi_cache[key_tuple])
-        else:
-            key_sum = (element, sum(sub_coord))
-            if element not in element_prob_vectors:
-                element_prob_vectors[element] = np.array([x[1] for x in element_to_iso_tuples[element]])
-            if key_sum not in multi_cache:
-                multi_cache[key_sum] = multinomial(key_sum[1], element_prob_vectors[element])
-            multi_cache[key_tuple] = multi_cache[key_sum].pmf(sub_coord)
-            sub_coord_probs.append(multi_cache[key_tuple])
-    return np.product(sub_coord_probs)
-
-mass_cache = {}
-element_mass_vectors = {}
-def calc_mass(iso_coord):
-    sub_coord_masses = []
-    for element, sub_coord in iso_coord.items():
-        key_tuple = (element, tuple(sub_coord))
-        if key_tuple in mass_cache:
-            sub_coord_masses.append(mass_cache[key_tuple])
-        else:
-            if element not in element_mass_vectors:
-                element_mass_vectors[element] = np.array([x[2] for x in element_to_iso_tuples[element]])
-            mass_cache[key_tuple] = np.dot(sub_coord, element_mass_vectors[element])
-        sub_coord_masses.append(mass_cache[key_tuple])
-    return np.sum(sub_coord_masses)
-
-neighbor_cache = {}
-delta_cache = {}
-def gen_neighbors(iso_coord):
-    new_coords = []
-    for _, sub_coord in iso_coord.items():
-        key = tuple(sub_coord)
-        if key not in neighbor_cache: 
-            neighbor_cache[key] = [sub_coord]
-            if len(sub_coord) > 1:
-                if len(sub_coord) not in delta_cache:
-                    delta_cache[len(sub_coord)] = np.array([x for x in itertools.permutations([-1, 1] + [0 for _ in range(len(sub_coord)-2)])], dtype=np.int16)           
-                for delta in delta_cache[len(sub_coord)]:
-                    new_coord = delta + sub_coord
-                    if not np.any(new_coord < 0):
-                        neighbor_cache[key].append(new_coord)
-        new_coords.append(neighbor_cache[key])
-    new_iso_coords = []
-    for coord_mask in np.ndindex(tuple([len(x) for x in new_coords])):
-        if not np.all(coord_mask == 0):
-            new_iso_coord = {}
-            for i, (index, k) in enumerate(zip(coord_mask, iso_coord.keys())):
-                new_iso_coord[k] = new_coords[i][index]
-            new_iso_coords.append(new_iso_coord)
-    return new_iso_coords
-
-def hash_isotopologue(isotopologue):
-    return "|".join([k + ','.join([str(x) for x in v]) for k,v in isotopologue.items()])
-
-delta_substrings = {}
-isotopes_vectors = {}
-def delta_info(isotopologue, reference):
-    delta_string = []
-    for element in isotopologue.keys():
-        iso_sub_coord, ref_sub_coord = isotopologue[element], reference[element]
-        key = (element, tuple(iso_sub_coord), tuple(ref_sub_coord))
-        if key not in delta_substrings:
+# isotopes with a lower natural abundance are not considered for isotopologues
+ISOTOPE_NAP_CUTOFF = .005
+# element -> [(isotope symbol, NAP, mass), ...] by decreasing NAP, built on first use by get_isotope_table
+_element_to_iso_tuples = None
+
+def get_isotope_table():
+    '''
+    Isotopes considered for isotopologue generation, from the packaged NIST table in data/isotopes.py.
+    Isotopes with a natural abundance below ISOTOPE_NAP_CUTOFF are left out, Sn and Os are limited to 
+    their two most abundant isotopes.
+
+    The table is loaded and compiled on the first call only, not at import, 
+    so that importing jms.ions (and each pool worker doing so) does not read it.
+    '''
+    global _element_to_iso_tuples
+    if _element_to_iso_tuples is None:
+        from .data.isotopes import isotopes
+        element_to_iso_tuples = {}
+        for element, (mass_numbers, masses, NAPs) in isotopes.items():
+            iso_NAPs = [(element + str(n), NAP, mass) for n, mass, NAP in zip(mass_numbers, masses, NAPs) if NAP > ISOTOPE_NAP_CUTOFF]
+            iso_NAPs = sorted(iso_NAPs, key=lambda x: -x[1])
+            if element == "Sn" or element == "Os":
+                iso_NAPs = iso_NAPs[:2]
+            if iso_NAPs:
+                element_to_iso_tuples[element] = iso_NAPs
+        _element_to_iso_tuples = element_to_iso_tuples
+    return _element_to_iso_tuples
+
+class LRUCache:
+    '''
+    Memo cache of at most maxsize entries, evicting the least recently used one when full.
+    Hits, misses and evictions are counted, see stats. 
+    The entries can be saved to disk and loaded back, e.g. to pre-warm a new process.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, compute):
+        '''
+        Return the value for key, calling compute(key) and storing the result on a miss.
+        '''
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute(key)
+            self.put(key, value)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize, 
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def save(self, path, version=None):
+        '''
+        Pickle the entries to path, written to a temporary file and renamed into place.
+        '''
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as O:
+            pickle.dump({'version': version, 'entries': list(self.entries.items())}, O, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path, version=None):
+        '''
+        Add the entries saved at path, unless they were saved with another version.
+        Returns the number of entries loaded.
+        '''
+        with open(path, 'rb') as O:
+            saved = pickle.load(O)
+        if saved.get('version') != version:
+            return 0
+        for key, value in saved['entries']:
+            self.put(key, value)
+        return len(saved['entries'])
+
+# bump when the values of isotopologue_cache change, saved caches of other versions are not loaded
+ISOTOPOLOGUE_CACHE_VERSION = 2
+# per element isotope arrays, and neighbour moves per combination of isotope counts
+element_isotopes_cache = LRUCache(256)
+neighbor_deltas_cache = LRUCache(1024)
+# isotopic distributions per (element, atom count, NAP_cutoff), see element_distribution
+element_distribution_cache = LRUCache(2 ** 14)
+# isotopologues kept by generate_ion_signature, per (formula, NAP_cutoff)
+isotopologue_cache = LRUCache(2 ** 16)
+
+def cache_stats():
+    '''
+    Statistics of the isotopologue caches, see LRUCache.stats.
+    '''
+    return {
+        'element_isotopes': element_isotopes_cache.stats(),
+        'neighbor_deltas': neighbor_deltas_cache.stats(),
+        'element_distributions': element_distribution_cache.stats(),
+        'isotopologues': isotopologue_cache.stats(),
+    }
+
+def prewarm_isotopologue_cache(formulas, NAP_cutoff=.01):
+    '''
+    Compute the isotopologues of formulas into isotopologue_cache ahead of generate_ion_signature.
+    '''
+    isotopologue_deltas_batch(formulas, NAP_cutoff)
+
+def save_isotopologue_cache(path):
+    isotopologue_cache.save(path, version=ISOTOPOLOGUE_CACHE_VERSION)
+
+def load_isotopologue_cache(path):
+    '''
+    Pre-warm isotopologue_cache from a file written by save_isotopologue_cache. 
+    Returns the number of entries loaded, 0 if the file is missing or of another version.
+    '''
+    if not os.path.isfile(path):
+        return 0
+    return isotopologue_cache.load(path, version=ISOTOPOLOGUE_CACHE_VERSION)
+
+def _element_isotopes(element):
+    '''
+    Isotope names, log abundances and masses of element, from get_isotope_table. The last abundance
+    is adjusted so that the abundances sum to 1, as scipy.stats.multinomial does.
+    '''
+    def compute(element):
+        from scipy.special import xlogy
+        isotopes = get_isotope_table()[element]
+        p = np.array([x[1] for x in isotopes], dtype=np.float64)
+        p_adjusted = 1. - p[:-1].sum()
+        if np.abs(p_adjusted) > 1e-15:
+            p[-1] = p_adjusted
+        return [x[0] for x in isotopes], xlogy(1, p), np.array([x[2] for x in isotopes], dtype=np.float64)
+    return element_isotopes_cache.get(element, compute)
+
+def _neighbor_deltas(isotope_counts):
+    '''
+    Neighbour moves for elements with isotope_counts isotopes each: all combinations of no change or 
+    moving one atom between two isotopes, per element, in the order the neighbours are explored. 
+    Duplicate moves of an element are dropped keeping the first.
+    '''
+    return neighbor_deltas_cache.get(isotope_counts, _compute_neighbor_deltas)
+
+def _compute_neighbor_deltas(isotope_counts):
+    options = []
+    for k in isotope_counts:
+        moves = [tuple([0] * k)]
+        if k > 1:
+            moves += [m for m in itertools.permutations([-1, 1] + [0 for _ in range(k - 2)])]
+        options.append(np.array(list(dict.fromkeys(moves)), dtype=np.int64))
+    deltas = np.zeros((int(np.prod([len(o) for o in options])), sum(isotope_counts)), dtype=np.int64)
+    bounds = np.cumsum([0] + list(isotope_counts))
+    for index, combination in enumerate(itertools.product(*[range(len(o)) for o in options])):
+        for option, start, stop, i in zip(options, bounds[:-1], bounds[1:], combination):
+            deltas[index, start:stop] = option[i]
+    deltas.setflags(write=False)
+    return deltas
+
+class IsotopologueModel:
+    '''
+    Isotopologues of one formula in log space.
+
+    An isotopologue is a vector of atom counts over the isotopes of each element of the formula,
+    concatenated in formula order. Its probability is the product over the elements of the multinomial
+    probability of the element's counts, as given by scipy.stats.multinomial:
+        log P = sum_e [ lgamma(n_e + 1) + sum_i (x_i * log p_i - lgamma(x_i + 1)) ]
+    lgamma(x + 1) is tabulated up to the largest atom count, so that the probabilities of any number
+    of isotopologues are evaluated by a few NumPy array operations, without scipy distribution objects.
+
+    Neighbours of an isotopologue are all combinations over the elements of either no change or moving 
+    one atom from one isotope to another, precomputed as one delta matrix.
+    '''
+    def __init__(self, formula):
+        from scipy.special import gammaln
+        self.elements = list(parse_chemformula_dict(formula).items())
+        isotopes = [_element_isotopes(element) for element, _ in self.elements]
+        isotope_counts = tuple(len(names) for names, _, _ in isotopes)
+        self.bounds = np.cumsum((0,) + isotope_counts).tolist()
+        self.slices = [slice(start, stop) for start, stop in zip(self.bounds[:-1], self.bounds[1:])]
+        self.isotope_names = [name for names, _, _ in isotopes for name in names]
+        self.log_p = np.concatenate([log_p for _, log_p, _ in isotopes]) if isotopes else np.zeros(0)
+        self.masses = [masses for _, _, masses in isotopes]
+        self.log_norms = gammaln(np.array([n for _, n in self.elements], dtype=np.float64) + 1)
+        self.lgamma_table = gammaln(np.arange(max([n for _, n in self.elements], default=0) + 1) + 1)
+        self.deltas = _neighbor_deltas(isotope_counts)
+        self.monoisotopic = np.zeros(self.bounds[-1], dtype=np.int64)
+        self.monoisotopic[self.bounds[:-1]] = [n for _, n in self.elements]
+
+    def probabilities(self, coords):
+        '''
+        Probabilities of the isotopologues in the rows of coords.
+        '''
+        if not self.slices:
+            return np.ones(coords.shape[0])
+        terms = coords * self.log_p - self.lgamma_table[coords]
+        element_probabilities = np.exp(self.log_norms + np.add.reduceat(terms, self.bounds[:-1], axis=1))
+        probabilities = element_probabilities[:, 0]
+        for i in range(1, element_probabilities.shape[1]):
+            probabilities = probabilities * element_probabilities[:, i]
+        return probabilities
+
+    def neighbors(self, coord):
+        '''
+        Neighbours of coord with no negative count, including coord itself.
+        '''
+        neighbors = coord + self.deltas
+        return neighbors[np.all(neighbors >= 0, axis=1)]
+
+    def mass(self, coord):
+        return np.sum([np.dot(coord[sl], masses) for sl, masses in zip(self.slices, self.masses)])
+
+    def as_dict(self, coord):
+        return {element: coord[sl] for (element, _), sl in zip(self.elements, self.slices)}
+
+    def delta_string(self, coord, reference):
+        '''
+        Isotopes gained relative to reference, e.g. '(C13,2O18)', or '' if none.
+        '''
+        delta_string = []
+        delta_values = (coord - reference).tolist()
+        for sl in self.slices:
             substring = []
-            delta_values = iso_sub_coord - ref_sub_coord
-            if element not in isotopes_vectors:
-                isotopes_vectors[element] = [x[0] for x in element_to_iso_tuples[element]]
-            for delta, iso_name in zip(delta_values, isotopes_vectors[element]):
+            for delta, iso_name in zip(delta_values[sl], self.isotope_names[sl]):
                 if delta > 1:
                     substring.append(str(delta) + iso_name)
                 elif delta == 1:
                     substring.append(iso_name)
-                else:
-                    pass
-                delta_substrings[key] = ",".join(substring)
-        delta_string.append(delta_substrings[key])
-    delta_string = '(' + ",".join([x for x in delta_string if x]) + ')'
-    if delta_string != '()':
-        return delta_string, calc_mass(isotopologue) - calc_mass(reference)
-    else:
-        return '', calc_mass(isotopologue) - calc_mass(reference)
+            delta_string.append(",".join(substring))
+        delta_string = '(' + ",".join([x for x in delta_string if x]) + ')'
+        return delta_string if delta_string != '()' else ''
 
+def _row_keys(coords):
+    # hashable key per row
+    if coords.shape[1] == 0:
+        return [b''] * coords.shape[0]
+    return np.ascontiguousarray(coords).view(np.dtype((np.void, coords.dtype.itemsize * coords.shape[1]))).ravel().tolist()
 
 def gen_isotopologues(formula, NAP_cutoff=0):
-    iso_coord = {}
-    for k, v in parse_chemformula_dict(formula).items():
-        iso_coord[k] = [0 for _ in element_to_iso_tuples[k]]
-        iso_coord[k][0] = v
-        iso_coord[k] = np.array(iso_coord[k], dtype=np.int16)
-    iso_heap = []
-    isos = [(-1 * calc_prob(x), x) for x in [iso_coord] + gen_neighbors(iso_coord)]
-    isos = sorted(isos, key=lambda x: x[0])
-    reference = isos[0][1]
-    used = set()
-    for NAP_prob, iso_coord in isos:
-        if -1 * NAP_prob > NAP_cutoff:
-            iso_hash = hash_isotopologue(iso_coord)
-            if iso_hash not in used:
-                heapq.heappush(iso_heap, (NAP_prob, iso_coord))
-                used.add(hash_isotopologue(iso_coord))
+    '''
+    Yield the isotopologues of formula in order of decreasing probability, as 
+    (NAP, {element: isotope counts}, mass, (delta_string, delta_mass)), 
+    where the deltas are relative to the most probable isotopologue among the monoisotopic one and its neighbours.
+
+    Explores from the monoisotopic isotopologue by a heap; the probabilities of all unseen neighbours
+    of a popped isotopologue are computed at once by IsotopologueModel.probabilities.
+    '''
+    model = IsotopologueModel(formula)
+    isos = np.vstack([model.monoisotopic, model.neighbors(model.monoisotopic)])
+    probabilities = model.probabilities(isos)
+    order = np.argsort(-probabilities, kind='stable')
+    reference = isos[order[0]]
+    reference_mass = model.mass(reference)
+    iso_heap, used, counter = [], set(), itertools.count()
+    keys = _row_keys(isos)
+    for i in order.tolist():
+        if probabilities[i] > NAP_cutoff and keys[i] not in used:
+            heapq.heappush(iso_heap, (-1 * probabilities[i], next(counter), isos[i]))
+            used.add(keys[i])
     while iso_heap:
-        NAP, most_abundant = heapq.heappop(iso_heap)
-        yield -1 * NAP, most_abundant, calc_mass(most_abundant), delta_info(most_abundant, reference)
-        for x in gen_neighbors(most_abundant):
-            hash = hash_isotopologue(x)
-            if hash not in used:
-                NAP_prob = calc_prob(x)
+        NAP, _, most_abundant = heapq.heappop(iso_heap)
+        mass = model.mass(most_abundant)
+        yield -1 * NAP, model.as_dict(most_abundant), mass, (model.delta_string(most_abundant, reference), mass - reference_mass)
+        neighbors = model.neighbors(most_abundant)
+        keys = _row_keys(neighbors)
+        unseen = [i for i, key in enumerate(keys) if key not in used]
+        if unseen:
+            for i, NAP_prob in zip(unseen, model.probabilities(neighbors[unseen]).tolist()):
                 if NAP_prob > NAP_cutoff:
-                    heapq.heappush(iso_heap, (-1 * NAP_prob, x))
-                    used.add(hash)
+                    heapq.heappush(iso_heap, (-1 * NAP_prob, next(counter), neighbors[i]))
+                    used.add(keys[i])
 
 def generate_ion_signature2(mw, neutral_formula, mode='pos', primary_only=True):
     adducts = compute_adducts_formulae(mw, neutral_formula, mode, primary_only)
@@ -195,11 +342,16 @@ def generate_ion_signature2(mw, neutral_formula, mode='pos', primary_only=True):
         ])
     return adducts + C13
 
-def generate_ion_signature(mw, neutral_formula, mode='pos', primary_only=True, C13_only=False, NAP_cutoff=.01):
+def generate_ion_signature(mw, neutral_formula, mode='pos', primary_only=True, C13_only=False, NAP_cutoff=.01, resolving_power=None):
     '''
     Extend mass2chem.formula.compute_adducts_formulae by C13 or any number of isotopologues
     based on NAP cutoff.
 
+    resolving_power: if given, isotopologues that cannot be resolved at this resolving power (m/dm) 
+    are merged into one ion at their intensity weighted centroid, see aggregate_isotopologue_deltas.
+    The merge window is set per adduct, by the m/z and charge of its ion.
+    Otherwise every fine structure isotopologue is an ion.
+
     Note - Resulting chemical formula is not computable.
     '''
     adducts = compute_adducts_formulae(mw, neutral_formula, mode, primary_only)
@@ -213,31 +365,249 @@ def generate_ion_signature(mw, neutral_formula, mode='pos', primary_only=True, C
         return adducts + C13
     else:
         isotopologues = []
-        for i, (NAP, _, _, (delta_string, delta_mass)) in enumerate(gen_isotopologues(neutral_formula)):
-            if NAP > NAP_cutoff:
-                for A in adducts:
-                    if delta_string:
-                        isotopologues.append([
-                            A[0] + delta_mass,
-                            A[1] + "," + delta_string[1:-1] + ";" + str(i),
-                            A[2] + "," + delta_string, 
-                            i,
-                        ])
-                    else:
-                        isotopologues.append([
-                            A[0] + delta_mass,
-                            A[1] + ";" + str(i),
-                            A[2],
-                            i,
-                        ])
-            else:
-                return isotopologues
-        isotopologues = []
-        for A in adducts:
-            isotopologues.append([
-                A[0],
-                A[1] + ";0",
-                A[2],
-                0,
-            ])
+        deltas = isotopologue_deltas(neutral_formula, NAP_cutoff)
+        if resolving_power:
+            adduct_deltas = [aggregate_isotopologue_deltas(deltas, A[0], resolving_power, ion_charge(A[1])) for A in adducts]
+        else:
+            adduct_deltas = [deltas] * len(adducts)
+        # ordered by isotopologue, then adduct
+        for i in range(max([len(x) for x in adduct_deltas], default=0)):
+            for A, A_deltas in zip(adducts, adduct_deltas):
+                if i >= len(A_deltas):
+                    continue
+                _, delta_string, delta_mass, _ = A_deltas[i]
+                if delta_string:
+                    isotopologues.append([
+                        A[0] + delta_mass,
+                        A[1] + "," + delta_string[1:-1] + ";" + str(i),
+                        A[2] + "," + delta_string, 
+                        i,
+                    ])
+                else:
+                    isotopologues.append([
+                        A[0] + delta_mass,
+                        A[1] + ";" + str(i),
+                        A[2],
+                        i,
+                    ])
         return isotopologues
+
+def isotopologue_deltas(formula, NAP_cutoff=.01):
+    '''
+    The isotopologues of formula used by generate_ion_signature, as (order, delta_string, delta_mass, NAP),
+    memoized in isotopologue_cache. These are the isotopologues, by decreasing probability, 
+    up to the first one with NAP <= NAP_cutoff. If all isotopologues are above the cutoff, 
+    only the first one is kept.
+    '''
+    return isotopologue_cache.get((formula, NAP_cutoff), _convolve_isotopologue_deltas)
+
+def ion_charge(ion_relation):
+    '''
+    Charge of an ion from its relation, e.g. 2 for 'M+2H[2+]', -1 for 'M-H[-]'.
+    '''
+    charge = re.search(r'\[(\d*)([+-])\]', ion_relation)
+    return int(charge.group(1) or 1) * (1 if charge.group(2) == '+' else -1)
+
+def aggregate_isotopologue_deltas(deltas, mz, resolving_power, charge=1):
+    '''
+    Merge the isotopologues in deltas, as given by isotopologue_deltas, that cannot be resolved 
+    at resolving_power in an ion of this m/z and charge: their m/z differ by at most mz / resolving_power, 
+    thus their masses by at most |charge| * mz / resolving_power. Isotopologues are grouped by increasing 
+    delta mass, a group spanning at most that window. Each group becomes one isotopologue at the NAP 
+    weighted mean of its delta masses, with the summed NAP and the delta string of its most abundant member. 
+    The groups are ordered by their first member in deltas and renumbered from 0.
+    '''
+    window = abs(charge) * mz / resolving_power
+    groups, group = [], []
+    for delta in sorted(deltas, key=lambda x: (x[2], x[0])):
+        if group and delta[2] - group[0][2] > window:
+            groups.append(group)
+            group = []
+        group.append(delta)
+    if group:
+        groups.append(group)
+    aggregated = []
+    for group in sorted(groups, key=lambda g: min(x[0] for x in g)):
+        NAP = sum(x[3] for x in group)
+        label = max(group, key=lambda x: (x[3], -x[0]))[1]
+        aggregated.append((len(aggregated), label, sum(x[2] * x[3] for x in group) / NAP, NAP))
+    return tuple(aggregated)
+
+def isotopologue_deltas_batch(formulas, NAP_cutoff=.01):
+    '''
+    isotopologue_deltas for a list of formulas at once, e.g. all formulas of a signature library.
+    Each distinct formula is computed once, and the per-element distributions (see element_distribution)
+    are shared by all formulas, so the cost grows with the distinct element counts rather than the formulas.
+    '''
+    formulas = list(formulas)
+    deltas = {formula: isotopologue_deltas(formula, NAP_cutoff) for formula in dict.fromkeys(formulas)}
+    return [deltas[formula] for formula in formulas]
+
+def _compute_isotopologue_deltas(key):
+    '''
+    isotopologue_deltas by the best-first search of gen_isotopologues over the joint isotopologues.
+    Reference implementation for _convolve_isotopologue_deltas.
+    '''
+    formula, NAP_cutoff = key
+    deltas = []
+    for i, (NAP, _, _, (delta_string, delta_mass)) in enumerate(gen_isotopologues(formula)):
+        if NAP > NAP_cutoff:
+            deltas.append((i, delta_string, delta_mass, NAP))
+        else:
+            return tuple(deltas)
+    return ((0, '', 0.0, 1.0),)
+
+#
+# Per-element convolution engine
+#
+# The probability of an isotopologue is the product of the multinomial probabilities of its elements,
+# which are independent. The distribution of n atoms of an element is thus computed once, pruned
+# to the sub-isotopologues above the NAP cutoff, and shared by all formulas with n atoms of it.
+# The isotopologues of a formula above the cutoff are the products of those of its elements,
+# combined one element at a time and pruned again, as a partial product only decreases.
+# The best-first search of gen_isotopologues is then replayed over these isotopologues only.
+#
+
+def element_distribution(element, n, NAP_cutoff=.01):
+    '''
+    The isotopic distribution of n atoms of element, as a dict of
+        coords: the sub-isotopologues with probability > NAP_cutoff, as atom counts per isotope
+        probabilities, masses: of those sub-isotopologues, computed as by IsotopologueModel
+        moves: moves[a, b] is the index of the move from coords[a] to coords[b] in options, -1 if none
+        from_monoisotopic: index of the move from the monoisotopic sub-isotopologue to each of coords, -1 if none
+        reference: the first most probable of the monoisotopic sub-isotopologue and its neighbours
+        reference_mass: mass of the reference
+        total: number of sub-isotopologues, above the cutoff or not
+    '''
+    return element_distribution_cache.get((element, n, NAP_cutoff), _compute_element_distribution)
+
+def _move_indices(sources, targets, options):
+    # index of the move from each of sources to each of targets in options, -1 if they are not neighbours
+    moves = targets[None, :, None, :] - sources[:, None, None, :] == options[None, None, :, :]
+    moves = np.all(moves, axis=3)
+    return np.where(np.any(moves, axis=2), np.argmax(moves, axis=2), -1)
+
+def _compute_element_distribution(key):
+    from math import comb
+    element, n, NAP_cutoff = key
+    model = IsotopologueModel(element + str(n) if n > 1 else element)
+    assert model.elements == [(element, n)], f"cannot model {n} atoms of {element}"
+    k, options = model.bounds[-1], model.deltas
+
+    candidates = model.neighbors(model.monoisotopic)
+    candidate_probabilities = model.probabilities(candidates)
+    reference = candidates[np.argsort(-candidate_probabilities, kind='stable')[0]]
+
+    # climb to the mode, then flood fill the sub-isotopologues above the cutoff, 
+    # these are connected by neighbour moves as the multinomial distribution is log-concave
+    mode, mode_probability = reference, candidate_probabilities.max()
+    while True:
+        neighbors = model.neighbors(mode)
+        probabilities = model.probabilities(neighbors)
+        if probabilities.max() <= mode_probability:
+            break
+        mode, mode_probability = neighbors[np.argmax(probabilities)], probabilities.max()
+    coords, frontier = [], mode[None, :] if mode_probability > NAP_cutoff else np.zeros((0, k), dtype=np.int64)
+    seen = set(_row_keys(frontier))
+    while frontier.shape[0]:
+        coords.append(frontier)
+        neighbors = (frontier[:, None, :] + options[None, :, :]).reshape(-1, k)
+        neighbors = neighbors[np.all(neighbors >= 0, axis=1)]
+        unseen = []
+        for i, row_key in enumerate(_row_keys(neighbors)):
+            if row_key not in seen:
+                seen.add(row_key)
+                unseen.append(i)
+        neighbors = neighbors[unseen]
+        frontier = neighbors[model.probabilities(neighbors) > NAP_cutoff]
+    coords = np.vstack(coords) if coords else np.zeros((0, k), dtype=np.int64)
+    return {
+        'coords': coords,
+        'probabilities': model.probabilities(coords),
+        'masses': np.array([model.mass(coord) for coord in coords], dtype=np.float64),
+        'moves': _move_indices(coords, coords, options),
+        'from_monoisotopic': _move_indices(model.monoisotopic[None, :], coords, options)[0],
+        'options': options.shape[0],
+        'reference': reference,
+        'reference_mass': model.mass(reference),
+        'isotope_names': model.isotope_names,
+        'total': comb(n + k - 1, k - 1)
+    }
+
+def _delta_substring(distribution, coord):
+    # isotopes of coord relative to the reference of its element, as in IsotopologueModel.delta_string
+    substring = []
+    for delta, iso_name in zip((coord - distribution['reference']).tolist(), distribution['isotope_names']):
+        if delta > 1:
+            substring.append(str(delta) + iso_name)
+        elif delta == 1:
+            substring.append(iso_name)
+    return ",".join(substring)
+
+def _convolve_isotopologue_deltas(key):
+    '''
+    isotopologue_deltas from the per-element distributions of formula. 
+
+    The isotopologues above the cutoff are combined from the element distributions, then yielded in the 
+    order of the best-first search of gen_isotopologues, which only pops isotopologues above the cutoff 
+    before stopping; the result is identical to _compute_isotopologue_deltas.
+    '''
+    formula, NAP_cutoff = key
+    elements = list(parse_chemformula_dict(formula).items())
+    distributions = [element_distribution(element, n, NAP_cutoff) for element, n in elements]
+
+    # rows of indices into the element distributions, with their probabilities multiplied in element order;
+    # these are few per formula, so plain floats are faster than arrays and give the same products
+    rows = [((), 1.0)]
+    for distribution in distributions:
+        element_probabilities = distribution['probabilities'].tolist()
+        rows = [(row + (a,), p * q) for row, p in rows for a, q in enumerate(element_probabilities) if p * q > NAP_cutoff]
+    moves = [d['moves'].tolist() for d in distributions]
+    radix = np.cumprod([1] + [d['options'] for d in distributions[::-1]])[:-1][::-1].tolist()
+
+    def rank(moves_per_element):
+        # rank of a move in the delta matrix of IsotopologueModel, None if not a neighbour
+        rank = 0
+        for move, r in zip(moves_per_element, radix):
+            if move < 0:
+                return None
+            rank += move * r
+        return rank
+
+    # replay the best-first search of gen_isotopologues, starting from the monoisotopic neighbours
+    from_monoisotopic = [d['from_monoisotopic'].tolist() for d in distributions]
+    start = [(rank([m[a] for m, a in zip(from_monoisotopic, row)]), i) for i, (row, _) in enumerate(rows)]
+    start = sorted([(-rows[i][1], r, i) for r, i in start if r is not None])
+    counter = itertools.count()
+    iso_heap = [(NAP, next(counter), i) for NAP, _, i in start]
+    used, popped = {i for _, _, i in start}, []
+    while iso_heap:
+        _, _, i = heapq.heappop(iso_heap)
+        popped.append(i)
+        row = rows[i][0]
+        unseen = [(rank([m[a][b] for m, a, b in zip(moves, row, rows[j][0])]), j) for j in range(len(rows)) if j not in used]
+        for _, j in sorted([(r, j) for r, j in unseen if r is not None]):
+            heapq.heappush(iso_heap, (-rows[j][1], next(counter), j))
+            used.add(j)
+    if len(popped) == int(np.prod([d['total'] for d in distributions])):
+        # every isotopologue is above the cutoff, only the first one is kept
+        return ((0, '', 0.0, 1.0),)
+
+    rows, NAPs = [rows[i][0] for i in popped], [rows[i][1] for i in popped]
+    if distributions and rows:
+        masses = np.sum(np.array([[d['masses'][a] for d, a in zip(distributions, row)] for row in rows]), axis=1).tolist()
+    else:
+        masses = [0.0] * len(rows)
+    reference_mass = np.sum([d['reference_mass'] for d in distributions])
+    substrings = [{} for _ in distributions]
+    deltas = []
+    for i, (row, mass, NAP) in enumerate(zip(rows, masses, NAPs)):
+        delta_string = []
+        for j, index in enumerate(row):
+            if index not in substrings[j]:
+                substrings[j][index] = _delta_substring(distributions[j], distributions[j]['coords'][index])
+            if substrings[j][index]:
+                delta_string.append(substrings[j][index])
+        delta_string = "(" + ",".join(delta_string) + ")" if delta_string else ''
+        deltas.append((i, delta_string, mass - reference_mass, NAP))
+    return tuple(deltas)
@@ -22,13 +22,15 @@ Out[17]:
   'snr': '3'}]
 '''
 
+import numpy as np
+
 def build_centurion_tree(list_peaks):
     '''
     list_peaks: [{'parent_masstrace_id': 1670, 'mz': 133.09702315984987, 'apex': 654, 'height': 14388.0, 
                     'left_base': 648, 'right_base': 655, 'id_number': 555}, ...]
     Return a dictionary, indexing mzList by 100*mz bins.
-    Because most high-resolution mass spectrometers measure well under 0.01 amu, 
-    one only needs to search the corresponding 0.01 bin and two adjacent bins (to capture bordering values).
+    A search visits the bins spanned by the m/z tolerance window, see centurion_bins;
+    with high-resolution data that is one or two 0.01 bins, more for wide tolerances or high m/z.
     list_mass_tracks has similar format as list_peaks.
     '''
     d = {}
@@ -64,14 +66,22 @@ def __build_centurion_tree_mzlist(mzList):
     return d
 
 
+def centurion_bins(query_mz, mz_tol):
+    '''
+    Return the range of 100*mz bins that can hold a value within mz_tol of query_mz.
+    Previously the bins q-1..q+1 were searched, which misses matches once mz_tol exceeds 0.01,
+    e.g. at 10 ppm above m/z 1000, and visits a needless bin for narrow tolerances.
+    '''
+    return range(int((query_mz - mz_tol) * 100), int((query_mz + mz_tol) * 100) + 1)
+
+
 def find_all_matches_centurion_indexed_list(query_mz, mz_centurion_tree, limit_ppm=5):
     '''
     Return matched peaks in mz_centurion_tree.
     '''
-    q = int(query_mz * 100)
     mz_tol = query_mz * limit_ppm * 0.000001
     results = []
-    for ii in (q-1, q, q+1):
+    for ii in centurion_bins(query_mz, mz_tol):
         L = mz_centurion_tree.get(ii, [])
         for peak in L:
             if abs(peak['mz']-query_mz) < mz_tol:
@@ -83,10 +93,9 @@ def find_best_match_centurion_indexed_list(query_mz, mz_centurion_tree, limit_pp
     '''
     Return matched indices in mz_centurion_tree (based on peak list).
     '''
-    q = int(query_mz * 100)
     mz_tol = query_mz * limit_ppm * 0.000001
     result = (None, 999)
-    for ii in (q-1, q, q+1):
+    for ii in centurion_bins(query_mz, mz_tol):
         L = mz_centurion_tree.get(ii, [])
         for peak in L:
             _d = abs(peak['mz']-query_mz)
@@ -96,6 +105,107 @@ def find_best_match_centurion_indexed_list(query_mz, mz_centurion_tree, limit_pp
     return result[0]
 
 
+def build_sorted_mz_index(list_peaks):
+    '''
+    Return (mz_array, sorted_peaks), list_peaks sorted by m/z with their m/z values as a numpy array.
+    This is the array counterpart of build_centurion_tree,
+    used when many m/z values (e.g. a whole spectrum) are searched at once.
+    '''
+    sorted_peaks = sorted(list_peaks, key=lambda p: p['mz'])
+    return np.array([p['mz'] for p in sorted_peaks], dtype=np.float64), sorted_peaks
+
+
+def find_all_matches_sorted_mz_index(query_mzs, mz_array, limit_ppm=5):
+    '''
+    Vectorized version of find_all_matches_centurion_indexed_list.
+    query_mzs is searched against sorted mz_array (from build_sorted_mz_index) in one pass,
+    using the same criterion abs(mz - query_mz) < query_mz * limit_ppm * 0.000001.
+
+    Return
+    ======
+    (query_indices, matched_indices), two int arrays of equal length,
+    ordered by query index, e.g. (array([0, 3, 3]), array([17, 52, 53]))
+    '''
+    query_mzs = np.asarray(query_mzs, dtype=np.float64)
+    mz_tol = query_mzs * limit_ppm * 0.000001
+    lower = np.searchsorted(mz_array, query_mzs - mz_tol, side='right')
+    upper = np.searchsorted(mz_array, query_mzs + mz_tol, side='left')
+    counts = np.maximum(upper - lower, 0)
+    total = counts.sum()
+    if not total:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    query_indices = np.repeat(np.arange(query_mzs.shape[0]), counts)
+    run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+    matched_indices = np.arange(total) - run_starts + np.repeat(lower, counts)
+    return query_indices, matched_indices
+
+
+def matches_to_csr(query_indices, matched_indices, query_mzs, mz_array):
+    '''
+    Convert matches ordered by query index, e.g. from find_all_matches_sorted_mz_index, to CSR form.
+
+    Return
+    ======
+    (offsets, matched_indices, ppm_errors), where the matches of query_mzs[i] are 
+    matched_indices[offsets[i]:offsets[i+1]], and ppm_errors the signed errors
+    (query_mz - mz) / query_mz * 1000000 of each match.
+    '''
+    query_mzs = np.asarray(query_mzs, dtype=np.float64)
+    offsets = np.zeros(query_mzs.shape[0] + 1, dtype=np.int64)
+    np.cumsum(np.bincount(query_indices, minlength=query_mzs.shape[0]), out=offsets[1:])
+    matched_mzs = query_mzs[query_indices]
+    ppm_errors = (matched_mzs - np.asarray(mz_array)[matched_indices]) / matched_mzs * 1000000
+    return offsets, matched_indices, ppm_errors
+
+
+def find_all_matches_sorted_mz_index_csr(query_mzs, mz_array, limit_ppm=5):
+    '''
+    find_all_matches_sorted_mz_index with the result in CSR form, see matches_to_csr.
+    '''
+    query_indices, matched_indices = find_all_matches_sorted_mz_index(query_mzs, mz_array, limit_ppm)
+    return matches_to_csr(query_indices, matched_indices, query_mzs, mz_array)
+
+
+def csr_to_lists(offsets, matched_indices, items):
+    '''
+    Return the CSR matches (see matches_to_csr) as one list of matched items per query.
+    '''
+    offsets, matched_indices = offsets.tolist(), matched_indices.tolist()
+    return [[items[j] for j in matched_indices[offsets[i]:offsets[i+1]]] for i in range(len(offsets) - 1)]
+
+
+def build_mz_occupancy(mz_array, limit_ppm=50):
+    '''
+    Return a boolean array over centurion bins, int(mz*100), marking the bins in which a query m/z
+    can match a value of mz_array within limit_ppm. Most peaks of a spectrum fall in unmarked bins,
+    thus checking the array first avoids the exact m/z comparison for them, see mz_occupied.
+    '''
+    mz_array = np.asarray(mz_array, dtype=np.float64)
+    if not mz_array.shape[0]:
+        return np.zeros(1, dtype=bool)
+    # a query q matches mz when abs(mz - q) < q * ppm, i.e. mz/(1+ppm) < q < mz/(1-ppm)
+    ppm = limit_ppm * 0.000001
+    # one bin of padding on each side guards against rounding at the bin edges
+    lower = np.maximum(np.floor(mz_array / (1 + ppm) * 100).astype(np.int64) - 1, 0)
+    upper = np.floor(mz_array / (1 - ppm) * 100).astype(np.int64) + 1
+    edges = np.zeros(upper.max() + 2, dtype=np.int64)
+    np.add.at(edges, lower, 1)
+    np.add.at(edges, upper + 1, -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def mz_occupied(query_mzs, occupancy):
+    '''
+    Return a boolean mask, True for the query m/z values that fall in an occupied bin of occupancy
+    (from build_mz_occupancy) and thus may have a match.
+    '''
+    bins = (np.asarray(query_mzs, dtype=np.float64) * 100).astype(np.int64)
+    in_range = (bins >= 0) & (bins < occupancy.shape[0])
+    mask = np.zeros(bins.shape[0], dtype=bool)
+    mask[in_range] = occupancy[bins[in_range]]
+    return mask
+
+
 def is_coeluted(P1, P2, rt_tolerance=10):
     '''
     coelution is defined by overlap more than half of the smaller peak, or apexes within rt_tolerance.
@@ -13,10 +13,11 @@ import logging
 import os
 
 from asarix.default_parameters import PARAMETERS
-from asarix.utils import logo
+from asarix.utils import logo, load_signatures
 from asarix.signature_generator import SignatureGenerator
 from asarix.scan_search import mzML_Searcher
 from asarix.scan_score import mzML_Search_Scorer
+from asarix.spectral_store import SpectralStore, mzml_scan_window
 
 from asarix.logger_setup import setup_logger
 setup_logger()
@@ -174,13 +175,65 @@ def main(params, dry_run=False):
         In other steps we can seach for and score these signatures to identify likely exposures
         to xenobiotic compounds. 
 
+        If the signature path ends in .jsonl, signatures are written as JSON Lines while they are
+        generated instead of being collected in memory first. With workers > 1 the compounds are
+        reacted in parallel processes, the signatures are the same as with one worker.
+
+        If base_signatures is given, that library is extended with the products of the compounds
+        not already in it, see SignatureGenerator.update_signatures. Signature IDs are deterministic,
+        so the IDs of the base signatures are unchanged.
+
+        Implausible or undetectable products are pruned as configured by min_mz, max_mz, max_elements,
+        min_rdbe and element_ratios, see SignatureGenerator.configure_pruning. If input is given, the
+        m/z range defaults to the scan window of its mzML files.
+
         Args:
             params (dict): the parameter dictionary, same payload for all methods
         """
         check_sufficient_params(params, ['compounds', 'reactions', 'signatures', 'reaction_depth'])
         SG = SignatureGenerator.from_compounds_reactions(params['compounds'], params['reactions'])
-        SG.generate_signatures(reaction_depth=params['reaction_depth'])
-        SG.save_signatures(signature_path=params['signatures'])
+        min_mz, max_mz = params.get('min_mz', None), params.get('max_mz', None)
+        if (min_mz is None or max_mz is None) and params.get('input', None):
+            window = mzml_scan_window(mzML_Searcher.filter_inputs(params['input']) or [])
+            if window:
+                logging.info(f"pruning products by the scan window of the input, {window[0]} - {window[1]} m/z")
+                min_mz = window[0] if min_mz is None else min_mz
+                max_mz = window[1] if max_mz is None else max_mz
+        min_mass, max_mass = SignatureGenerator.mz_range_to_mass_range(min_mz, max_mz)
+        SG.configure_pruning(min_mass=min_mass,
+                             max_mass=max_mass,
+                             max_elements=params.get('max_elements', None),
+                             min_rdbe=params.get('min_rdbe', None),
+                             element_ratios=params.get('element_ratios', None))
+        if params.get('base_signatures', None):
+            SG.update_signatures(load_signatures(params['base_signatures']), reaction_depth=params['reaction_depth'], workers=params.get('workers', 1))
+            SG.save_signatures(signature_path=params['signatures'])
+        elif params['signatures'].endswith(".jsonl"):
+            SG.stream_signatures(params['signatures'], reaction_depth=params['reaction_depth'], workers=params.get('workers', 1))
+        else:
+            SG.generate_signatures(reaction_depth=params['reaction_depth'], workers=params.get('workers', 1))
+            SG.save_signatures(signature_path=params['signatures'])
+
+    def mzml_preprocess(params):
+        """
+        Convert mzML files into spectral stores (see spectral_store.py), memory-mappable 
+        arrays of the decoded MS1 spectra. mzml_search uses the store of an mzML file 
+        whenever one exists, skipping the XML parsing and decoding of the spectra. 
+
+        The input must be a path to either an individual mzML file or a directory with multiple 
+        such files. Each store is written next to its mzML file.
+
+        Args:
+            params (dict): Asari-X params dict
+        """
+        try:
+            check_sufficient_params(params, ['input'])
+            mzml_files = mzML_Searcher.filter_inputs(params['input'])
+            SpectralStore.from_mzml_files(mzml_files, workers=params.get('workers', 1))
+            return (1, None)
+        except Exception as e:
+            print(f"Error Executing mzml_preprocess:\n {e}")
+            return (0, e)
 
     def mzml_search(params): 
         """
@@ -197,8 +250,6 @@ def main(params, dry_run=False):
         """
         try:
             check_sufficient_params(params, ['input', 'signatures', 'mz_tolerance_ppm'])
-            if isinstance(params['signatures'], str) and params['signatures'].endswith('json'):
-                params['signatures'] = json.load(open(params['signatures']))['data']
             XS = mzML_Searcher.from_params(params)
             XS.search()
             return (1, None)
@@ -11,21 +11,26 @@ import numpy as np
 import tqdm
 
 from scipy.stats import spearmanr
-from asarix.utils import consecutive_scans
+from asarix.utils import consecutive_scans, load_signatures, signature_digest
 
+# signature libraries loaded by this process, by digest, so each is read once per process
+_signature_libraries = {}
 
 class mzML_Search_Scorer():
     """
     This object implements the mzML search scoring
     """
-    def __init__(self, snr_cutoff=None, scan_cutoff=None, scan_files=None):
+    def __init__(self, snr_cutoff=None, scan_cutoff=None, scan_files=None, signature_path=None, mz_tolerance_ppm=None):
         self.frequencies = {}
         self.max_scans = {}
         self.snr_cutoff = snr_cutoff
         self.scan_cutoff = scan_cutoff
         self.scan_files = scan_files[:1]
+        self.signature_path = signature_path
+        self.mz_tolerance_ppm = mz_tolerance_ppm
         assert self.snr_cutoff > 0, "snr_cutoff must be positive"
         assert self.scan_cutoff >= 0, "scan_cutoff must be non-negative"
+        assert self.mz_tolerance_ppm is None or self.mz_tolerance_ppm > 0, "mz_tolerance_ppm must be positive"
 
     @staticmethod
     def filter_inputs(input, extension_filter="ASARIX.json"):
@@ -37,7 +42,7 @@ class mzML_Search_Scorer():
 
         Args:
             input (str): path to mzML or directory with mzML files within it.
-            extension_filter (str, optional): return files matching this extension. Defaults to "mzML".
+            extension_filter (str or tuple, optional): return files matching this extension or any of these extensions. Defaults to "ASARIX.json".
 
         Raises:
             Warning: raise if no mzML files were found
@@ -77,25 +82,198 @@ class mzML_Search_Scorer():
             mzML_Search_Scorer: _description_
         """
 
-        scan_files = mzML_Search_Scorer.filter_inputs(params['input'], extension_filter=".scans_ASARIX.json")
-        return mzML_Search_Scorer(params['snr_cutoff'], params['scan_cutoff'], scan_files)
+        scan_files = mzML_Search_Scorer.filter_inputs(params['input'], extension_filter=(".scans_ASARIX.npz", ".scans_ASARIX.json"))
+        # if a search was saved in both formats, score only the columnar one
+        scan_files = [f for f in scan_files if not (f.endswith(".json") and f.replace(".json", ".npz") in scan_files)]
+        signature_path = params.get('signatures', None)
+        return mzML_Search_Scorer(params['snr_cutoff'], 
+                                  params['scan_cutoff'], 
+                                  scan_files, 
+                                  signature_path=signature_path if isinstance(signature_path, str) else None,
+                                  mz_tolerance_ppm=params.get('score_mz_tolerance_ppm', None))
     
     def score(self):
-        jobs = [(x, self.snr_cutoff, self.scan_cutoff) for x in self.scan_files]
+        jobs = [(x, self.snr_cutoff, self.scan_cutoff, self.signature_path, self.mz_tolerance_ppm) for x in self.scan_files]
         with mp.Pool(mp.cpu_count()) as workers:
             r = list(tqdm.tqdm(workers.imap(self.score_signatures_wrapped, jobs), total=len(self.scan_files)))
 
     def score_signatures_wrapped(self, job):
-        return self.score_signatures(job[0], job[1], job[2])
+        return self.score_signatures(job[0], job[1], job[2], job[3], job[4])
 
     @staticmethod
-    def digest_signatures(sig_dict, scan_cutoff):
+    def load_signature_library(reference, signature_path=None):
+        """
+        Load the signature library referenced by a search output. Each library is read once 
+        per process and reused for every file searched against it.
+
+        Args:
+            reference (dict): {"path": ..., "digest": ...} as written by mzML_Searcher
+            signature_path (str, optional): read the library from here instead of the recorded path. Defaults to None.
+
+        Raises:
+            ValueError: the library on disk is not the one that was searched
+
+        Returns:
+            list: the signatures
+        """
+        if reference["digest"] not in _signature_libraries:
+            signature_path = signature_path if signature_path else reference["path"]
+            logging.info(f"loading signatures from {signature_path}")
+            signatures = load_signatures(signature_path)
+            if signature_digest(signatures) != reference["digest"]:
+                raise ValueError(f"signatures in {signature_path} differ from those used for the search")
+            _signature_libraries[reference["digest"]] = signatures
+        return _signature_libraries[reference["digest"]]
+
+    @staticmethod
+    def load_scan_data(file, scan_cutoff, mz_tolerance_ppm=None):
+        """
+        Read the output of an mzML search, either the columnar *.scans_ASARIX.npz or 
+        *.scans_ASARIX.json, and digest its hits. 
+
+        Args:
+            file (str): path to the scan data
+            scan_cutoff (int): hits with intensity at or below this are discarded
+            mz_tolerance_ppm (float, optional): if given, discard hits with a larger ppm error. Defaults to None.
+
+        Raises:
+            ValueError: mz_tolerance_ppm is wider than the tolerance of the search
+
+        Returns:
+            tuple: the scan data without its hits, and the digested hits, see digest_signatures
+        """
+        if file.endswith(".npz"):
+            with np.load(file) as columns:
+                sig_dict = json.loads(str(columns["metadata"]))
+                mzML_Search_Scorer.check_tolerance(sig_dict, mz_tolerance_ppm, file)
+                digested = mzML_Search_Scorer.digest_columns(columns, scan_cutoff, mz_tolerance_ppm)
+        else:
+            with open(file) as scan_fh:
+                sig_dict = json.load(scan_fh)
+            mzML_Search_Scorer.check_tolerance(sig_dict, mz_tolerance_ppm, file)
+            digested = mzML_Search_Scorer.digest_signatures(sig_dict.pop('hits'), scan_cutoff, mz_tolerance_ppm, sig_dict.pop('dropped', {}))
+        return sig_dict, digested
+
+    @staticmethod
+    def check_tolerance(sig_dict, mz_tolerance_ppm, file):
+        """
+        Hits beyond the search tolerance were never recorded, thus scoring at a wider tolerance 
+        would silently behave like the search tolerance. Outputs that predate recording the 
+        search tolerance are not checked.
+
+        Args:
+            sig_dict (dict): the scan data, see load_scan_data
+            mz_tolerance_ppm (float): the score tolerance, or None
+            file (str): path to the scan data, for the error message
+
+        Raises:
+            ValueError: mz_tolerance_ppm is wider than the tolerance of the search
+        """
+        search_tolerance = sig_dict.get("mz_tolerance_ppm", None)
+        if mz_tolerance_ppm and search_tolerance and mz_tolerance_ppm > search_tolerance:
+            raise ValueError(f"score tolerance of {mz_tolerance_ppm} ppm exceeds the search tolerance of {search_tolerance} ppm in {file}")
+
+    @staticmethod
+    def digest_columns(columns, scan_cutoff, mz_tolerance_ppm=None):
+        """
+        Columnar counterpart of digest_signatures for the arrays written by 
+        mzML_Searcher.hits_to_columns. Every signature is kept, even if none of its 
+        hits pass scan_cutoff.
+
+        Args:
+            columns (dict): signatures, signature_id, scan, intensity, mz, rt, ppm_error, dropped_id, 
+                dropped_intensity, dropped_mz and dropped_ppm_error arrays
+            scan_cutoff (int): hits with intensity at or below this are discarded
+            mz_tolerance_ppm (float, optional): if given, discard hits with a larger ppm error. Defaults to None.
+
+        Raises:
+            ValueError: mz_tolerance_ppm is given but the hits have no ppm errors
+
+        Returns:
+            dict: same format as digest_signatures
+        """
+        if mz_tolerance_ppm and "ppm_error" not in columns:
+            raise ValueError("the scan data was searched without per hit ppm errors, search again to score with mz_tolerance_ppm")
+        keep = mzML_Search_Scorer.passes_cutoffs(columns["intensity"], columns["ppm_error"], scan_cutoff, mz_tolerance_ppm)
+        signature_id = columns["signature_id"][keep]
+        order = np.argsort(signature_id, kind="stable")
+        scans = columns["scan"][keep][order].astype(np.int64)
+        intensities = columns["intensity"][keep][order]
+        masses = columns["mz"][keep][order]
+        times = columns["rt"][keep][order]
+        signatures = columns["signatures"]
+        # dropped hits are counted only if they pass the same cutoffs as the kept hits
+        dropped_masses = np.zeros(0, dtype=np.float64)
+        dropped_bounds = np.zeros(len(signatures) + 1, dtype=np.int64)
+        if "dropped_id" in columns:
+            dropped_keep = mzML_Search_Scorer.passes_cutoffs(columns["dropped_intensity"], columns["dropped_ppm_error"], scan_cutoff, mz_tolerance_ppm)
+            dropped_id = columns["dropped_id"][dropped_keep]
+            dropped_order = np.argsort(dropped_id, kind="stable")
+            dropped_masses = columns["dropped_mz"][dropped_keep][dropped_order]
+            dropped_bounds = np.searchsorted(dropped_id[dropped_order], np.arange(len(signatures) + 1))
+        bounds = np.searchsorted(signature_id[order], np.arange(len(signatures) + 1))
+        return {
+            str(s): {
+                "scans": scans[bounds[i]:bounds[i+1]],
+                "intensities": intensities[bounds[i]:bounds[i+1]].tolist(),
+                "masses": masses[bounds[i]:bounds[i+1]].tolist(),
+                "times": times[bounds[i]:bounds[i+1]].tolist(),
+                "dropped": int(dropped_bounds[i+1] - dropped_bounds[i]),
+                "dropped_masses": dropped_masses[dropped_bounds[i]:dropped_bounds[i+1]].tolist(),
+            } for i, s in enumerate(signatures)
+        }
+
+    @staticmethod
+    def passes_cutoffs(intensities, ppm_errors, scan_cutoff, mz_tolerance_ppm=None):
+        """
+        Mask of the hits with intensity above scan_cutoff and, if given, a ppm error within mz_tolerance_ppm.
+
+        Args:
+            intensities (np.ndarray): hit intensities
+            ppm_errors (np.ndarray): hit ppm errors
+            scan_cutoff (int): hits with intensity at or below this are discarded
+            mz_tolerance_ppm (float, optional): if given, discard hits with a larger ppm error. Defaults to None.
+
+        Returns:
+            np.ndarray: boolean mask of the hits to keep
+        """
+        keep = np.asarray(intensities) > scan_cutoff
+        if mz_tolerance_ppm:
+            keep &= np.abs(np.asarray(ppm_errors)) < mz_tolerance_ppm
+        return keep
+
+    @staticmethod
+    def digest_signatures(sig_dict, scan_cutoff, mz_tolerance_ppm=None, dropped=None):
+        """
+        Collect the hits of each signature ion that pass the cutoffs into parallel lists.
+
+        Args:
+            sig_dict (dict): hits from mzML_Searcher.search_file
+            scan_cutoff (int): hits with intensity at or below this are discarded
+            mz_tolerance_ppm (float, optional): if given, discard hits with a larger ppm error. Defaults to None.
+            dropped (dict, optional): (intensity, mz, ppm_error) of the hits dropped during the search, per signature ion. Defaults to None.
+
+        Raises:
+            ValueError: mz_tolerance_ppm is given but the hits have no ppm errors
+
+        Returns:
+            dict: signature ion: {"scans", "intensities", "masses", "times", "dropped", "dropped_masses"}
+        """
+        dropped = dropped if dropped else {}
+        if mz_tolerance_ppm:
+            # hits of searches predating ppm errors are (scan, intensity, mz, time)
+            if any(len(x) < 5 for d in sig_dict.values() for x in d):
+                raise ValueError("the scan data was searched without per hit ppm errors, search again to score with mz_tolerance_ppm")
+            sig_dict = {s: [x for x in d if abs(x[4]) < mz_tolerance_ppm] for s, d in sig_dict.items()}
+            dropped = {s: [x for x in d if abs(x[2]) < mz_tolerance_ppm] for s, d in dropped.items()}
         return {
             s: {
                 "scans": np.array([x[0] for x in d if x[1] > scan_cutoff]),
                 "intensities": [x[1] for x in d if x[1] > scan_cutoff],
                 "masses": [x[2] for x in d if x[1] > scan_cutoff],
                 "times": [x[3] for x in d if x[1] > scan_cutoff],
+                "dropped": len([x for x in dropped.get(s, []) if x[0] > scan_cutoff]),
+                "dropped_masses": [x[1] for x in dropped.get(s, []) if x[0] > scan_cutoff],
             } for s, d in sig_dict.items()
         }
     
@@ -129,13 +307,14 @@ class mzML_Search_Scorer():
         return _t
 
     @staticmethod
-    def score_signatures(file, snr_cutoff, scan_cutoff):
+    def score_signatures(file, snr_cutoff, scan_cutoff, signature_path=None, mz_tolerance_ppm=None):
         scores = {"scores": {}}
-        sig_dict = json.load(open(file))
-        digested = mzML_Search_Scorer.digest_signatures(sig_dict['hits'], scan_cutoff)
-        topo_sig = mzML_Search_Scorer.topo_sort_signatures(sig_dict['hits'])
+        sig_dict, digested = mzML_Search_Scorer.load_scan_data(file, scan_cutoff, mz_tolerance_ppm)
+        topo_sig = mzML_Search_Scorer.topo_sort_signatures(digested)
         for signature in topo_sig.keys():
-            S = mzML_Search_Scorer.score_signature(signature, topo_sig, digested, sig_dict["max_scan"], snr_cutoff)
+            S = mzML_Search_Scorer.score_signature(signature, topo_sig, digested, sig_dict["max_scan"], snr_cutoff,
+                                                   max_gap=sig_dict.get("max_gap", 2), 
+                                                   min_group_size=sig_dict.get("min_group_size", 2))
             for k, v in S.items():
                 if v[0] > 0:
                     if signature not in scores["scores"]:
@@ -150,15 +329,17 @@ class mzML_Search_Scorer():
                         "integral": v[3],
                         "mz": v[4]
                     })
-        with open(file.replace(".scans_ASARIX.json", ".scores.json"), 'w+') as out_fh:
+        with open(file.replace(".scans_ASARIX.npz", ".scores.json").replace(".scans_ASARIX.json", ".scores.json"), 'w+') as out_fh:
             for k, v in sig_dict.items():
                 if k != 'hits':
                     scores[k] = v
+            if "signature_map" not in scores:
+                scores["signature_map"] = mzML_Search_Scorer.load_signature_library(scores["signatures"], signature_path)
             scores = mzML_Search_Scorer.consolidate_sig_scores(scores)
             json.dump(scores, out_fh, indent=4)
 
     @staticmethod
-    def score_signature(signature, topo_sig, digested, max_scans, snr_cutoff):
+    def score_signature(signature, topo_sig, digested, max_scans, snr_cutoff, max_gap=2, min_group_size=2):
         print(signature)
         scores = {}
         maps = []
@@ -171,7 +352,7 @@ class mzML_Search_Scorer():
             }
             maps.append(map)
 
-        scan_sets = [consecutive_scans(digested[iso]["scans"]) for iso in topo_sig[signature]]
+        scan_sets = [consecutive_scans(digested[iso]["scans"], max_gap=max_gap, min_group_size=min_group_size) for iso in topo_sig[signature]]
         filter_empty = []
         for ss in scan_sets:
             if ss:
@@ -179,7 +360,11 @@ class mzML_Search_Scorer():
             else:
                 break
         scan_sets = filter_empty
-        ion_counts = [len(digested[iso]["scans"]) for iso in topo_sig[signature]]
+        # hits in runs too short to score were dropped by the searcher but still count towards the frequency
+        ion_counts = [len(digested[iso]["scans"]) + digested[iso].get("dropped", 0) for iso in topo_sig[signature]]
+        # mean m/z of all hits of the first ion, dropped or not, sorted so that it does not depend on which were dropped
+        first_ion = digested[topo_sig[signature][0]]
+        mz = float(np.mean(np.sort(first_ion["masses"] + first_ion.get("dropped_masses", []))))
         if scan_sets and scan_sets[0]:
             for index in np.ndindex(tuple([len(s) for s in scan_sets])):
                 working_scan_sets = [scan_sets[i][j] for i,j in enumerate(index)]
@@ -229,7 +414,7 @@ class mzML_Search_Scorer():
                         total_score, 
                         len(working_scan_sets[0]), 
                         ion_counts[0] / max_scans, 
-                        int(integral), float(np.mean(list(maps[0]["M"].values()))))    
+                        int(integral), mz)    
         return scores
 
     @staticmethod
@@ -246,13 +431,11 @@ class mzML_Search_Scorer():
                     if uuid not in sigscores:
                         sigscores[uuid] = 0
                     sigscores[uuid] += pseudo_feature["score"]
+        # signatures may be shared with other files scored by this process, do not modify them
         new_signatures = []
         for _d in scores["signature_map"]:
             if _d['uuid'] in sigscores:
-                _d["score"] = sigscores[_d["uuid"]]
-                new_signatures.append(_d)
-            else:
-                _d["score"] = 0
+                new_signatures.append(dict(_d, score=sigscores[_d["uuid"]]))
         scores['signature_map'] = new_signatures
         del scores['sigmap']
         return scores
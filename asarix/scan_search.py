@@ -7,56 +7,189 @@ future search functions will be added.
 
 import json
 import os
+import shutil
+import tempfile
 import logging
+import multiprocessing as mp
 from collections import defaultdict
+from operator import itemgetter
 
-import pymzml
+import numpy as np
 import tqdm
 from jms.dbStructures import knownCompoundDatabase
+from jms.ions import load_isotopologue_cache, save_isotopologue_cache, cache_stats
+
+from asarix.utils import signature_digest, iter_signatures, ConsecutiveScanEncoder
+from asarix.spectral_store import SpectralStore, iter_mzml_spectra
 
 import logging
 logging.getLogger(__name__)
 #todo - seems that the logging does not always work correctly, see build_KCD
 #todo - the logs are being redirected to khipu.log...
 
+# bump when the layout or the contents of the cached KCD index change
+KCD_CACHE_VERSION = 3
+
+# the searcher, with its KCD, as seen by a pool worker; set once per worker by _init_worker
+_worker_searcher = None
+
+def _init_worker(searcher):
+    """
+    Pool initializer. With the fork start method the searcher is inherited copy-on-write 
+    from the parent, otherwise it arrives as a pickled snapshot. Either way the KCD is 
+    built only once, in the parent.
+
+    Args:
+        searcher (mzML_Searcher): the configured searcher from the parent process
+    """
+    global _worker_searcher
+    _worker_searcher = searcher
+
+def _search_and_save(file):
+    """
+    Search and save a single mzML file in a pool worker.
+
+    Args:
+        file (str): path to mzml file
+
+    Returns:
+        str: path to mzml file
+    """
+    logging.info(f"searching {file}")
+    _worker_searcher.save_scan_data(_worker_searcher.search_file(file))
+    return file
+
 class mzML_Searcher():
     """
     mzML searcher takes a set of signatures and searches the mzml files for matching peaks
+
+    The signatures are either passed in memory or, with signatures None, streamed from 
+    signature_path each time they are needed, see iter_signature_library.
     """
-    def __init__(self, signatures, mzml_files, ppm, limit=None):
+    # open runs of hits are checked for closing every this many scans
+    RUN_SWEEP_INTERVAL = 100
+
+    def __init__(self, signatures, mzml_files, ppm, limit=None, workers=1, cache_dir=None, scan_format="npz", signature_path=None, max_gap=2, min_group_size=2, resolving_power=None):
         self.signatures = signatures
+        self.signature_path = os.path.abspath(signature_path) if signature_path else None
+        assert self.signatures is not None or self.signature_path, "signatures or a signature_path is required"
+        self.signature_digest = signature_digest(self.iter_signature_library())
         self.mzml_files = mzml_files
         if limit and isinstance(limit, int):
             self.mzml_files = self.mzml_files[:min(len(self.mzml_files), limit)]
-        self.KCD = self.build_KCD()
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.resolving_power = resolving_power
+        self.KCD = self.build_KCD(resolving_power=resolving_power)
         self.ppm = ppm
+        self.workers = workers if workers else 1
+        self.scan_format = scan_format
+        self.max_gap = max_gap
+        self.min_group_size = min_group_size
+        assert self.workers > 0, "workers must be positive"
+        assert self.scan_format in {"npz", "json"}, "scan_format must be npz or json"
 
-    def build_KCD(self):
+    def build_KCD(self, primary_only=True, include_C13=True, resolving_power=None):
         """
         For the set of provided signatures, build the the knownCompoundDatabase
         (KCD) to allow for the search to occur. 
 
+        If a cache_dir is configured, the compiled KCD is stored there under a hash of 
+        the signatures and the index options, and later runs with the same signatures 
+        load it, memory-mapped, instead of regenerating every ion. The isotopologues of 
+        each formula are also kept there, so that a KCD for a changed library, e.g. one 
+        extended with a few compounds, only computes those of the new formulas.
+
+        Args:
+            primary_only (bool, optional): passed to build_emp_cpds_index. Defaults to True.
+            include_C13 (bool, optional): passed to build_emp_cpds_index. Defaults to True.
+            resolving_power (float, optional): passed to build_emp_cpds_index. Defaults to None.
+
         Returns:
             knownCompoundDatabase: KCD for the signatures
         """
-        logging.info(f"building KCD from signatures")
         KCD = knownCompoundDatabase()
-        KCD.mass_index_list_compounds(self.signatures)
-        KCD.build_emp_cpds_index(primary_only=True, include_C13=True)
+        index_dir = None
+        if self.cache_dir:
+            digest = signature_digest([self.signature_digest], 
+                                      primary_only=primary_only, 
+                                      include_C13=include_C13, 
+                                      resolving_power=resolving_power,
+                                      cache_version=KCD_CACHE_VERSION)
+            index_dir = os.path.join(self.cache_dir, "kcd_" + digest)
+            if os.path.isdir(index_dir):
+                logging.info(f"loading cached KCD from {index_dir}")
+                KCD.load_index(index_dir)
+                return KCD
+        logging.info(f"building KCD from signatures")
+        isotopologue_path = os.path.join(self.cache_dir, "isotopologues.pickle") if index_dir else None
+        if isotopologue_path:
+            logging.info(f"loaded {load_isotopologue_cache(isotopologue_path)} cached isotopologues")
+        KCD.mass_index_list_compounds(self.iter_signature_library())
+        KCD.build_emp_cpds_index(primary_only=primary_only, include_C13=include_C13, resolving_power=resolving_power)
+        logging.info(f"isotopologue caches: {cache_stats()}")
+        if index_dir:
+            logging.info(f"caching KCD to {index_dir}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write next to the final location then rename, so that concurrent runs never see a partial index
+            tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".kcd_")
+            KCD.save_index(tmp_dir)
+            try:
+                os.rename(tmp_dir, index_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            save_isotopologue_cache(isotopologue_path)
         return KCD
     
+    def iter_signature_library(self):
+        """
+        Iterate over the signatures, streaming them from signature_path when they were not 
+        passed in memory, see asarix.utils.iter_signatures.
+
+        Returns:
+            iterator: the signatures
+        """
+        if self.signatures is not None:
+            return iter(self.signatures)
+        return iter_signatures(self.signature_path)
+
     def search(self):
         """
-        This method will execute the search_file function on each mzML_file
-        in parallel (eventually). This is a wrapper essentially. 
+        This method will execute the search_file function on each mzML_file, 
+        in a pool of self.workers processes if more than one worker is requested.
+        This is a wrapper essentially. 
 
         All Asari-X searchers implement a search method, allowing a future 
         abstract base class implementation, and a common interface.
         """
-        for file in tqdm.tqdm(self.mzml_files, desc="searching mzML"):
-            logging.info(f"searching {file}")
-            feature_dict = self.search_file(file)
-            self.save_scan_data(feature_dict)
+        if self.workers > 1 and len(self.mzml_files) > 1:
+            workers = min(self.workers, len(self.mzml_files))
+            logging.info(f"searching {len(self.mzml_files)} files with {workers} workers")
+            with mp.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+                for _ in tqdm.tqdm(pool.imap(_search_and_save, self.mzml_files), total=len(self.mzml_files), desc="searching mzML"):
+                    pass
+        else:
+            for file in tqdm.tqdm(self.mzml_files, desc="searching mzML"):
+                logging.info(f"searching {file}")
+                feature_dict = self.search_file(file)
+                self.save_scan_data(feature_dict)
+
+    @staticmethod
+    def iter_spectra(file):
+        """
+        Lazily read the MS1 spectra of an mzML file or of a spectral store made from one 
+        (see spectral_store.py), one at a time, so that only the current spectrum is held 
+        in memory. Polarity is determined for each scan. 
+
+        Args:
+            file (string): path to mzml file or spectral store
+
+        Yields:
+            tuple: (mode, scan_time in seconds, mz array, intensity array) for each MS1 scan
+        """
+        if SpectralStore.is_store(file):
+            yield from SpectralStore(file).iter_spectra()
+        else:
+            yield from iter_mzml_spectra(file)
 
     def search_file(self, file):
         """
@@ -64,53 +197,84 @@ class mzML_Searcher():
 
         As the KCD was configured from signatures.
 
+        Spectra are streamed from the file and each is searched and released before the 
+        next is read, thus memory use is one spectrum plus the hits found so far.
+
+        Each hit is (scan, intensity, mz, time, ppm_error), where ppm_error is the signed 
+        mass error of the observed m/z relative to the signature ion, in ppm of the observed 
+        m/z. Searching once at a wide tolerance, narrower tolerances can later be applied 
+        by the scorer without re-reading the mzML.
+
+        Hits are grouped into consecutive scan runs per signature ion as they are found, 
+        with the same max_gap and min_group_size as consecutive_scans. Runs spanning fewer 
+        than min_group_size scans cannot contribute to a score and are dropped as soon as 
+        they close, only (intensity, mz, ppm_error) of their hits is kept, in "dropped", so that 
+        the scorer can still compute ion frequencies and mean m/z with the same cutoffs as for kept hits.
+
         Args:
-            file (string): path to mzml file
+            file (string): path to mzml file or spectral store
+
+        The signature library itself is not copied into the result, only a reference to it,
+        see signature_reference.
 
         Returns:
-            _type_: _description_
+            dict: the hits, signature mapping and run information for the file
         """
         infile = file
-        all_hits = []
+        runs = ConsecutiveScanEncoder(max_gap=self.max_gap, min_group_size=self.min_group_size, dropped_fields=itemgetter(1, 2, 4))
         signature_map = defaultdict(set)
         scan_no = 0
         modes = set()
-        search_mz_single = self.KCD.search_mz_single
+        search_mz_spectrum = self.KCD.search_mz_spectrum
+        ion_table = self.KCD.ion_table
+        # signature ion keys, by ion table row, for the ions that were hit
+        keys = {}
         try:
-            experiment = pymzml.run.Reader(infile)
-            specs = [(None, 'pos' if spec['positive scan'] else 'neg', spec.scan_time_in_minutes() * 60, spec.mz, spec.i) for spec in experiment if spec.ms_level==1]
-            for scan_no, (_, spec_mode, scan_time, spec_mzs, spec_is) in enumerate(specs):
+            for scan_no, (spec_mode, scan_time, spec_mzs, spec_is) in enumerate(self.iter_spectra(infile)):
                 modes.add(spec_mode)
-                for m, i in zip(spec_mzs, spec_is):
-                    result = search_mz_single(m, mode=spec_mode, mz_tolerance_ppm=self.ppm)
-                    for t in result:
-                        all_hits.extend([(t['interim_id'] + '$' + t['ion_relation'], scan_no, int(i), m, scan_time)])
-                        for cpd in t['compounds']:
-                            signature_map[t['interim_id'] + '$' + t['ion_relation']].add(cpd['uuid'])
+                peak_indices, ion_indices = search_mz_spectrum(spec_mzs, mode=spec_mode, mz_tolerance_ppm=self.ppm)
+                hit_mzs = spec_mzs[peak_indices]
+                ppm_errors = ((hit_mzs - ion_table.mz[ion_indices]) / hit_mzs * 1e6).tolist()
+                for p, t, ppm_error in zip(peak_indices.tolist(), ion_indices.tolist(), ppm_errors):
+                    if t not in keys:
+                        keys[t] = ion_table.ion_key(t)
+                        signature_map[keys[t]].update(cpd['uuid'] for cpd in ion_table.parents[ion_table.parent[t]]['compounds'])
+                    runs.add(keys[t], scan_no, (scan_no, int(spec_is[p]), spec_mzs[p], scan_time, ppm_error))
+                if scan_no % self.RUN_SWEEP_INTERVAL == 0:
+                    runs.close_before(scan_no)
         except:
             pass
+        runs.close_all()
         feature_dict = {
             "sigmap": {k: list(v) for k,v in signature_map.items()},
-            "sample": infile,
+            "sample": SpectralStore.source_path(infile) if SpectralStore.is_store(infile) else infile,
             "max_scan": scan_no,
-            "hits": self.hits_to_feature_dict(all_hits),
-            "signature_map": self.signatures
+            "mz_tolerance_ppm": self.ppm,
+            "hits": runs.hits,
+            "dropped": runs.dropped,
+            "max_gap": self.max_gap,
+            "min_group_size": self.min_group_size,
         }
+        feature_dict.update(self.signature_reference())
         if list(modes):
             feature_dict["mode"] = list(modes)[0] if len(modes) == 1 else "multiple"
         else:
             feature_dict["mode"] = None
         return feature_dict
     
-    @staticmethod
-    def hits_to_feature_dict(hits):
-        feature_dict = {}
-        for hit in hits:
-            if hit[0] not in feature_dict:
-                feature_dict[hit[0]] = []
-            feature_dict[hit[0]].append(hit[1:])
-        return feature_dict
-    
+    def signature_reference(self):
+        """
+        Describe the signature library for the search output. When the library was read 
+        from a file, only its path and content hash are recorded and the scorer loads the 
+        library itself. Signatures passed in memory are embedded, as before. 
+
+        Returns:
+            dict: {"signatures": {"path": ..., "digest": ...}} or {"signature_map": [...]}
+        """
+        if self.signature_path:
+            return {"signatures": {"path": self.signature_path, "digest": self.signature_digest}}
+        return {"signature_map": self.signatures}
+
     @staticmethod
     def export_feature_dict(feature_dict):
         s = 'formula_mass@ion\tscan_numbers\tintensity\n'
@@ -121,11 +285,60 @@ class mzML_Searcher():
             out_fh.write(s)
 
     def save_scan_data(self, feature_dict):
-        out_path = os.path.join(".", os.path.abspath(feature_dict["sample"]).replace('.mzML', '.scans_ASARIX.json'))
-        with open(out_path, 'w+') as out_fh:
+        """
+        Save the result of search_file next to its mzML file, in self.scan_format.
+
+        "npz" writes *.scans_ASARIX.npz, a columnar file with one typed array per hit field, 
+        see hits_to_columns. "json" writes the same data as *.scans_ASARIX.json for export. 
+
+        Args:
+            feature_dict (dict): result of search_file
+        """
+        if self.scan_format == "json":
+            out_path = os.path.join(".", os.path.abspath(feature_dict["sample"]).replace('.mzML', '.scans_ASARIX.json'))
+            with open(out_path, 'w+') as out_fh:
+                logging.info(f"saving scan data to {out_path}")
+                json.dump(feature_dict, out_fh, indent=4)
+        else:
+            out_path = os.path.join(".", os.path.abspath(feature_dict["sample"]).replace('.mzML', '.scans_ASARIX.npz'))
             logging.info(f"saving scan data to {out_path}")
-            json.dump(feature_dict, out_fh, indent=4)
-        
+            metadata = {k: v for k, v in feature_dict.items() if k not in {"hits", "dropped"}}
+            np.savez_compressed(out_path, 
+                                metadata=np.array(json.dumps(metadata)), 
+                                **self.hits_to_columns(feature_dict["hits"], feature_dict["dropped"]))
+
+    @staticmethod
+    def hits_to_columns(hits, dropped):
+        """
+        Convert the hits of a feature_dict, {signature: [(scan, intensity, mz, time, ppm_error), ...]}, 
+        into typed column arrays. Rows are grouped by signature in the order of hits.
+
+        Args:
+            hits (dict): hits from search_file
+            dropped (dict): (intensity, mz, ppm_error) of the dropped hits per signature, from search_file
+
+        Returns:
+            dict: signatures (str); per hit, signature_id (index into signatures), scan, intensity, 
+            mz, rt and ppm_error arrays; per dropped hit, dropped_id, dropped_intensity, dropped_mz and 
+            dropped_ppm_error arrays
+        """
+        rows = [row for v in hits.values() for row in v]
+        scans, intensities, mzs, rts, ppm_errors = zip(*rows) if rows else ((), (), (), (), ())
+        dropped_rows = [row for k in hits for row in dropped[k]]
+        dropped_intensities, dropped_mzs, dropped_ppm_errors = zip(*dropped_rows) if dropped_rows else ((), (), ())
+        return {
+            "signatures": np.array(list(hits.keys()), dtype=str),
+            "signature_id": np.repeat(np.arange(len(hits), dtype=np.int32), [len(v) for v in hits.values()]),
+            "scan": np.array(scans, dtype=np.int32),
+            "intensity": np.array(intensities, dtype=np.int64),
+            "mz": np.array(mzs, dtype=np.float64),
+            "rt": np.array(rts, dtype=np.float64),
+            "ppm_error": np.array(ppm_errors, dtype=np.float32),
+            "dropped_id": np.repeat(np.arange(len(hits), dtype=np.int32), [len(dropped[k]) for k in hits]),
+            "dropped_intensity": np.array(dropped_intensities, dtype=np.int64),
+            "dropped_mz": np.array(dropped_mzs, dtype=np.float64),
+            "dropped_ppm_error": np.array(dropped_ppm_errors, dtype=np.float32),
+        }
 
     @staticmethod
     def filter_inputs(input, extension_filter="mzML"):
@@ -161,6 +374,31 @@ class mzML_Searcher():
             logging.warn(f"{input} could not be processed")
             raise Warning("Could not infer mzML file locations")
 
+    @staticmethod
+    def find_spectra(input):
+        """
+        Find the mzML files in input, substituting the spectral store of an mzML file 
+        when one exists. Stores without their mzML file are included as well. 
+
+        Args:
+            input (str): path to mzML, spectral store or directory with either within it.
+
+        Returns:
+            list: list of absolute paths to mzML files and spectral stores
+        """
+        if SpectralStore.is_store(input):
+            return [os.path.abspath(input)]
+        mzml_files = mzML_Searcher.filter_inputs(input) or []
+        stores = []
+        if os.path.isdir(input):
+            stores = mzML_Searcher.filter_inputs(input, extension_filter=SpectralStore.EXTENSION)
+        elif os.path.isfile(input) and SpectralStore.is_store(SpectralStore.store_path(os.path.abspath(input))):
+            stores = [SpectralStore.store_path(os.path.abspath(input))]
+        inputs = [SpectralStore.store_path(f) if SpectralStore.store_path(f) in stores else f for f in mzml_files]
+        inputs += [f for f in stores if f not in inputs]
+        logging.info(f"{len(stores)} of {len(inputs)} inputs are spectral stores")
+        return inputs
+
     @staticmethod
     def from_params(params):
         """
@@ -173,5 +411,18 @@ class mzML_Searcher():
             mzML_Searcher: a configured mzML_Searcher instance
         """
         logging.info(f"creating mzML_searcher from params, input: {params['input']}")
-        mzml_files = mzML_Searcher.filter_inputs(params['input'])
-        return mzML_Searcher(params['signatures'], mzml_files, params['mz_tolerance_ppm'])
\ No newline at end of file
+        mzml_files = mzML_Searcher.find_spectra(params['input'])
+        signatures, signature_path = params['signatures'], None
+        if isinstance(signatures, str):
+            # streamed from disk as needed rather than held by the searcher
+            signature_path, signatures = signatures, None
+        return mzML_Searcher(signatures, 
+                             mzml_files, 
+                             params['mz_tolerance_ppm'], 
+                             workers=params.get('workers', 1), 
+                             cache_dir=params.get('cache_dir', None),
+                             scan_format=params.get('scan_format', "npz"),
+                             signature_path=signature_path,
+                             max_gap=params.get('max_gap', 2),
+                             min_group_size=params.get('min_group_size', 2),
+                             resolving_power=params.get('resolving_power', None))
\ No newline at end of file
@@ -5,17 +5,52 @@ This is used during mzML scan searching currently and will be required for featu
 
 """
 import json
+import os
+import shutil
+import tempfile
 import uuid
+import zlib
 import logging
-from itertools import product
+import multiprocessing as mp
+from itertools import combinations_with_replacement
 
+import numpy as np
 import tqdm
 
 from asarix.utils import sum_formula_dicts
-from mass2chem.formula import parse_chemformula_dict, dict_to_hill_formula, calculate_formula_mass, calculate_mass
+from mass2chem.formula import parse_chemformula_dict, atom_mass_dict, compute_adducts_formulae
 
 logger = logging.getLogger(__name__)
 
+# the generator and its product plan as seen by a pool worker; set once per worker by _init_worker
+_worker_generator = None
+_worker_plan = None
+
+def _init_worker(generator, plan):
+    """
+    Pool initializer. The compounds and the precomputed reaction combinations are sent to 
+    each worker once, instead of with every chunk of compounds.
+
+    Args:
+        generator (SignatureGenerator): the configured generator from the parent process
+        plan (dict): see SignatureGenerator.product_plan
+    """
+    global _worker_generator, _worker_plan
+    _worker_generator, _worker_plan = generator, plan
+
+def _group_chunk(bounds):
+    """
+    Generate and group the products of one chunk of compounds in a pool worker.
+
+    Args:
+        bounds (tuple): start and stop index of the chunk in the compound list
+
+    Returns:
+        tuple: see SignatureGenerator.group_products
+    """
+    start, stop = bounds
+    return SignatureGenerator.group_products(_worker_generator.iter_products(plan=_worker_plan, start=start, stop=stop))
+
 class SignatureGenerator():
     """
     SignatureGenerator creates signatures for search. 
@@ -23,10 +58,28 @@ class SignatureGenerator():
     You can create a signature generator eitehr from existing signatures or from
     a set of input compounds and reactions. 
     """
+    # upper bound on the number of elements in the product count array of one chunk of compounds
+    GENERATION_CHUNK_SIZE = 2 ** 22
+    # upper bound on the number of products grouped at once when products are grouped per chunk
+    GROUPING_CHUNK_SIZE = 2 ** 14
+    # namespace of the uuid5 IDs of compounds and signatures, changing it changes every ID
+    UUID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/shuzhao-li-lab/Asari-X")
+    # searched isotopologues are at most this much heavier than the monoisotopic ion
+    ISOTOPE_MASS_MARGIN = 5.0
+    # valences for the RDBE, 1 + sum(n * (valence - 2)) / 2, elements not listed are ignored
+    VALENCES = {"C": 4, "(C13)": 4, "Si": 4, "H": 1, "F": 1, "Cl": 1, "Br": 1, "I": 1, "N": 3, "P": 3, "O": 2, "S": 2}
+    # element to carbon ratio ranges of the seven golden rules (Kind and Fiehn, 2007)
+    ELEMENT_RATIOS = {
+        "common": {"H": (0.2, 3.1), "F": (0, 1.5), "Cl": (0, 0.8), "Br": (0, 0.8), "N": (0, 1.3), "O": (0, 1.2), "P": (0, 0.3), "S": (0, 0.8), "Si": (0, 0.5)},
+        "extended": {"H": (0.1, 6), "F": (0, 6), "Cl": (0, 2), "Br": (0, 2), "N": (0, 4), "O": (0, 3), "P": (0, 2), "S": (0, 3), "Si": (0, 1)}
+    }
+
     def __init__(self, compounds, reactions, signatures):
         self.compounds, self.uuid_map = self.__initialize_compounds(compounds)
         self.reactions  = self.__initialize_reactions(reactions)
         self.signatures = signatures
+        self.merged_count = 0
+        self.pruning = {}
         #self.__at_creation = [compounds, reactions, signatures]
         assert isinstance(self.compounds, (list, type(None)))
         assert isinstance(self.reactions, (list, type(None)))
@@ -38,8 +91,8 @@ class SignatureGenerator():
         Compounds may require additional data wrangling to be useful. This method cleans
         up the input compounds for use. 
 
-        This also assigns the compounds a unique UUID, allowing the mapping of signatures to 
-        compounds and reactions easily.
+        This also assigns the compounds a UUID, see compound_uuid, allowing the mapping of signatures 
+        to compounds and reactions easily. A uuid given in the input compound is kept.
 
         Args:
             compounds (list): list of input compounds
@@ -55,7 +108,7 @@ class SignatureGenerator():
                     cpd = {}
                     cpd["parent"] = None
                     cpd["reactions"] = []
-                    cpd["uuid"] = str(uuid.uuid4())
+                    cpd["uuid"] = SignatureGenerator.compound_uuid(compound)
                     for k, v in compound.items():
                         cpd[k] = v
                     new_cpds.append(cpd)
@@ -67,6 +120,41 @@ class SignatureGenerator():
         else:
             return None, None
     
+    @staticmethod
+    def compound_uuid(compound):
+        """
+        Deterministic UUID of an input compound, so that builds of the same compounds can be 
+        compared and extended. The identity of a compound is its primary_db, primary_id and 
+        neutral_formula if it has a primary_id, otherwise the whole compound record.
+
+        Args:
+            compound (dict): an input compound
+
+        Returns:
+            str: uuid5 of the compound identity
+        """
+        if compound.get('primary_id', None) is not None:
+            identity = f"{compound.get('primary_db', '')}:{compound['primary_id']}:{compound['neutral_formula']}"
+        else:
+            identity = json.dumps(compound, sort_keys=True, default=str)
+        return str(uuid.uuid5(SignatureGenerator.UUID_NAMESPACE, identity))
+
+    @staticmethod
+    def signature_uuid(neutral_formula, neutral_formula_mass):
+        """
+        Deterministic UUID of a generated signature. Signatures are merged by formula and mass, 
+        see group_products, so these identify the signature regardless of which compounds and 
+        reaction paths give it.
+
+        Args:
+            neutral_formula (str): formula of the signature
+            neutral_formula_mass (float): mass of the signature
+
+        Returns:
+            str: uuid5 of the signature
+        """
+        return str(uuid.uuid5(SignatureGenerator.UUID_NAMESPACE, f"{neutral_formula}_{neutral_formula_mass:.6f}"))
+
     @staticmethod
     def __initialize_reactions(reactions):
         """
@@ -129,66 +217,519 @@ class SignatureGenerator():
         logging.info("creating signature generator from compounds and reactions")
         return SignatureGenerator(compounds, reactions, None)
 
+    def configure_pruning(self, min_mass=None, max_mass=None, max_elements=None, min_rdbe=None, element_ratios=None):
+        """
+        Rules for products that are not worth searching for. Products failing any rule are dropped in 
+        iter_products, before their formula and provenance are materialized. All rules are off by default.
+
+        Args:
+            min_mass (float, optional): lowest neutral mass to keep, see mz_range_to_mass_range. Defaults to None.
+            max_mass (float, optional): highest neutral mass to keep. Defaults to None.
+            max_elements (str, optional): formula of the maximum count of each element, e.g. "C100H200N20", 
+                elements not in the formula are not limited. Defaults to None.
+            min_rdbe (float, optional): lowest ring and double bond equivalent to keep, see VALENCES. Defaults to None.
+            element_ratios (str, optional): "common" or "extended" element to carbon ratio ranges to keep, 
+                see ELEMENT_RATIOS, products without carbon are not checked. Defaults to None.
+        """
+        assert element_ratios in (None, "none", *self.ELEMENT_RATIOS), f"unknown element_ratios {element_ratios}"
+        self.pruning = {k: v for k, v in {
+            "min_mass": min_mass,
+            "max_mass": max_mass,
+            "max_elements": parse_chemformula_dict(max_elements) if max_elements else None,
+            "min_rdbe": min_rdbe,
+            "element_ratios": self.ELEMENT_RATIOS[element_ratios] if element_ratios not in (None, "none") else None
+        }.items() if v is not None}
+        if self.pruning:
+            logging.info(f"pruning products by {self.pruning}")
+
+    @staticmethod
+    def mz_range_to_mass_range(min_mz, max_mz):
+        """
+        The neutral masses whose primary ions, in either mode, or their isotopologues can fall within 
+        the m/z range of a run. The adducts are those of compute_adducts_formulae with primary_only, as 
+        searched by mzML_Searcher, which are all singly charged.
+
+        Args:
+            min_mz (float): lowest m/z acquired, or None
+            max_mz (float): highest m/z acquired, or None
+
+        Returns:
+            tuple: lowest and highest neutral mass, None where the m/z was None
+        """
+        shifts = [ion[0] - 1000 for mode in ("pos", "neg") for ion in compute_adducts_formulae(1000, "C10H20N2O5S", mode=mode, primary_only=True)]
+        return (min_mz - max(shifts) - SignatureGenerator.ISOTOPE_MASS_MARGIN if min_mz is not None else None,
+                max_mz - min(shifts) if max_mz is not None else None)
+
     def cartesian_product_reactions(self, reaction_depth):
         """
-        When we need to reaction M compounds with N reactions up to K times, it is easier to simply 
-        calculate the cartesian product of the reactions by calculating the cartesian product of N 
-        with repeat of i for i between 0 and K, thus generating the powerset of all reaction combinations. 
+        When we need to reaction M compounds with N reactions up to K times, we enumerate the 
+        multisets of i reactions, for i between 0 and K, as the order in which reactions are 
+        applied does not change the product. A+B and B+A are thus generated once.
+
+        Distinct reaction combinations can still sum to the same formula_dict, these are merged 
+        into one entry, named after the first combination, with every combination listed in 
+        reaction_paths. 
 
         We can then react each reaction combination with each compound later to generate signatures. 
 
         Args:
-            reaction_depth (int): the maximum depth to which reactions should be permuted.
+            reaction_depth (int): the maximum depth to which reactions should be combined.
 
         Returns:
-            list: powerset of reaction permutations out to depth
+            list: reaction combinations out to depth, each with reaction_name, reaction_paths and formula_dict
         """
-        logging.info(f"generating product of reactions to depth {reaction_depth}")
-        all_reactions = [{"reaction_name": "", "formula_dict": {}}]
-        for i in tqdm.tqdm(range(reaction_depth), position=0, leave=False, desc="Iterating Depth"):
-            for combo in tqdm.tqdm(product(self.reactions, repeat=i), position=1, leave=False, desc="Iterating Reaction Permutations"):
+        logging.info(f"generating combinations of reactions to depth {reaction_depth}")
+        all_reactions = {(): {"reaction_name": "", "reaction_paths": [""], "formula_dict": {}}}
+        num_combos = 1
+        for i in tqdm.tqdm(range(1, reaction_depth), position=0, leave=False, desc="Iterating Depth"):
+            for combo in tqdm.tqdm(combinations_with_replacement(self.reactions, i), position=1, leave=False, desc="Iterating Reaction Combinations"):
+                num_combos += 1
                 combined_formula = sum_formula_dicts([r["formula_dict"] for r in combo])
                 combined_rxn_name = "+".join(r["reaction_name"] for r in combo)
-                if combined_rxn_name:
-                    all_reactions.append({
+                key = tuple(sorted(combined_formula.items()))
+                if key in all_reactions:
+                    all_reactions[key]["reaction_paths"].append(combined_rxn_name)
+                else:
+                    all_reactions[key] = {
                         "reaction_name": combined_rxn_name,
+                        "reaction_paths": [combined_rxn_name],
                         "formula_dict": combined_formula
-                    })
-        logging.info(f"generated {len(all_reactions)} reaction permutations")
-        return all_reactions
+                    }
+        logging.info(f"generated {num_combos} reaction combinations, {len(all_reactions)} with distinct formulas")
+        return list(all_reactions.values())
+
+    def product_plan(self, reaction_depth=3):
+        """
+        Everything iter_products needs that is shared by all compounds: the reaction combinations 
+        out to reaction_depth, the element axis, the element count matrices of the compounds and 
+        the reaction combinations, and the pruning rules over the element axis. Computed once, also when the compounds are split between 
+        processes, so that every chunk uses the same element axis.
+
+        Args:
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+
+        Returns:
+            dict: the reaction combinations, elements, element masses, count matrices and pruning rules
+        """
+        all_rxns = self.cartesian_product_reactions(reaction_depth + 1)
+        cpd_formulas = [parse_chemformula_dict(cpd['neutral_formula']) for cpd in self.compounds]
+        rxn_formulas = [rxn['formula_dict'] for rxn in all_rxns]
+        elements = self.__hill_order({e for formula in cpd_formulas + rxn_formulas for e in formula})
+        cpd_counts, cpd_present = self.__element_count_matrix(cpd_formulas, elements)
+        rxn_counts, rxn_present = self.__element_count_matrix(rxn_formulas, elements)
+        return {
+            "reactions": all_rxns,
+            "elements": elements,
+            "element_masses": np.array([atom_mass_dict[e] for e in elements], dtype=np.float64),
+            "cpd_counts": cpd_counts,
+            "cpd_present": cpd_present,
+            "rxn_counts": rxn_counts,
+            "rxn_present": rxn_present,
+            "pruning": self.__pruning_plan(elements)
+        }
+
+    def iter_products(self, reaction_depth=3, plan=None, start=0, stop=None):
+        """
+        Generate the products of each compound with each reaction combination, out to reaction_depth,
+        one chunk of compounds at a time. Products with the same formula are not merged here, see
+        merge_products.
+
+        Compounds and reaction combinations are converted to element count matrices over a shared 
+        element axis, the products of a chunk of compounds with all reactions are then computed by
+        broadcast addition. A product is valid if every element present in either the compound or the 
+        reaction has a positive count. Valid products failing the pruning rules, see configure_pruning,
+        are dropped. Hill formulas are computed for the remaining products only.
+
+        Args:
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+            plan (dict, optional): precomputed product_plan, reaction_depth is ignored if given. Defaults to None.
+            start (int, optional): index of the first compound to react. Defaults to 0.
+            stop (int, optional): index after the last compound to react. Defaults to all compounds.
+
+        Yields:
+            dict: a product, neutral_formula_mass, neutral_formula and its provenance, 
+            {"parent": compound uuid, "reactions": ..., "reaction_paths": [...]}
+        """
+        plan = plan if plan is not None else self.product_plan(reaction_depth)
+        all_rxns, elements, element_masses = plan["reactions"], plan["elements"], plan["element_masses"]
+        rxn_counts, rxn_present = plan["rxn_counts"][None, :, :], plan["rxn_present"][None, :, :]
+        stop = len(self.compounds) if stop is None else stop
+        chunk_size = self.__chunk_size(plan)
+        # progress is shown for the whole compound list only, not for the chunks of pool workers
+        for chunk_start in tqdm.tqdm(range(start, stop, chunk_size), leave=False, desc="Reacting Compounds:", disable=stop - start < len(self.compounds)):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            counts = plan["cpd_counts"][chunk_start:chunk_stop, None, :] + rxn_counts
+            present = plan["cpd_present"][chunk_start:chunk_stop, None, :] | rxn_present
+            valid = np.all((counts > 0) | ~present, axis=2) & np.any(present, axis=2)
+            cpd_indices, rxn_indices = np.nonzero(valid)
+            counts = counts[valid]
+            masses = counts @ element_masses
+            if plan["pruning"]:
+                keep = self.__prune(counts, masses, plan["pruning"])
+                counts, masses, cpd_indices, rxn_indices = counts[keep], masses[keep], cpd_indices[keep], rxn_indices[keep]
+            for formula, mass, c, r in zip(self.__hill_formulas(counts, elements), 
+                                           masses.tolist(), 
+                                           (cpd_indices + chunk_start).tolist(),
+                                           rxn_indices.tolist()):
+                yield {
+                    "neutral_formula_mass": round(mass, 6),
+                    "neutral_formula": formula,
+                    "provenance": {
+                        "parent": self.compounds[c]['uuid'],
+                        "reactions": all_rxns[r]['reaction_name'],
+                        "reaction_paths": all_rxns[r]['reaction_paths']
+                    }
+                }
+
+    def iter_product_groups(self, reaction_depth=3, workers=1, chunked=False):
+        """
+        Generate the products of the compounds grouped by formula, see group_products. 
+
+        With workers > 1 the compounds are split into chunks that are reacted and grouped by a 
+        pool of processes, each against the same precomputed product_plan. The groups of the 
+        chunks are yielded in compound order, so combining them with merge_signatures gives the
+        same signatures as a single worker. With one worker, all compounds are a single group 
+        unless chunked is set, in which case each chunk of compounds is grouped separately so that
+        only one chunk of products is held in memory at a time.
 
-    def generate_signatures(self, reaction_depth=3):
+        Args:
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+            workers (int, optional): number of processes generating products. Defaults to 1.
+            chunked (bool, optional): with one worker, group per chunk of compounds. Defaults to False.
+
+        Yields:
+            tuple: the signatures of one chunk of compounds, without UUIDs, and its number of products
+        """
+        plan = self.product_plan(reaction_depth)
+        if workers > 1 and len(self.compounds) > 1:
+            # smaller chunks than memory allows, so that the workers finish at about the same time
+            chunk_size = max(1, min(self.__chunk_size(plan), -(-len(self.compounds) // (workers * 8))))
+            bounds = [(start, min(start + chunk_size, len(self.compounds))) for start in range(0, len(self.compounds), chunk_size)]
+            with mp.Pool(min(workers, len(bounds)), initializer=_init_worker, initargs=(self, plan)) as pool:
+                yield from tqdm.tqdm(pool.imap(_group_chunk, bounds), total=len(bounds), desc="Reacting Compounds:")
+        elif chunked:
+            chunk_size = max(1, min(self.__chunk_size(plan), self.GROUPING_CHUNK_SIZE // max(1, len(plan["reactions"]))))
+            for start in tqdm.tqdm(range(0, len(self.compounds), chunk_size), desc="Reacting Compounds:"):
+                yield self.group_products(self.iter_products(plan=plan, start=start, stop=min(start + chunk_size, len(self.compounds))))
+        else:
+            # a single group, fastest when the library fits in memory
+            yield self.group_products(self.iter_products(plan=plan))
+
+    @staticmethod
+    def group_products(products):
+        """
+        Products with the same formula and mass, from different parent compounds or reaction paths, 
+        are a single signature. Each (parent compound uuid, reaction path) that gives the product is 
+        listed in its provenance, reactions and reaction_paths are those of the first. 
+
+        Args:
+            products (iterable): products, see iter_products
+
+        Returns:
+            tuple: list of signatures, without UUIDs, and the number of products merged into them
+        """
+        signatures = {}
+        num_products = 0
+        for product in products:
+            num_products += 1
+            key = (product["neutral_formula"], product["neutral_formula_mass"])
+            if key in signatures:
+                signatures[key]["provenance"].append(product["provenance"])
+            else:
+                signatures[key] = {
+                    "neutral_formula_mass": product["neutral_formula_mass"],
+                    "neutral_formula": product["neutral_formula"],
+                    "reactions": product["provenance"]["reactions"],
+                    "reaction_paths": product["provenance"]["reaction_paths"],
+                    "provenance": [product["provenance"]]
+                }
+        return list(signatures.values()), num_products
+
+    @staticmethod
+    def merge_signatures(signatures):
+        """
+        Merge signatures with the same formula and mass, e.g. from groups of different chunks of 
+        compounds, by concatenating their provenance in order. Each merged signature is assigned 
+        its UUID, see signature_uuid.
+
+        Args:
+            signatures (iterable): signatures without UUIDs, see group_products
+
+        Returns:
+            list: the merged signatures
+        """
+        merged = {}
+        for signature in signatures:
+            key = (signature["neutral_formula"], signature["neutral_formula_mass"])
+            if key in merged:
+                merged[key]["provenance"].extend(signature["provenance"])
+            else:
+                merged[key] = signature
+        for signature in merged.values():
+            signature["uuid"] = SignatureGenerator.signature_uuid(signature["neutral_formula"], signature["neutral_formula_mass"])
+        return list(merged.values())
+
+    @staticmethod
+    def merge_products(products):
+        """
+        Merge products into signatures, see group_products, and assign each signature a UUID.
+
+        Args:
+            products (iterable): products, see iter_products
+
+        Returns:
+            tuple: list of signatures and the number of products merged into them
+        """
+        signatures, num_products = SignatureGenerator.group_products(products)
+        return SignatureGenerator.merge_signatures(signatures), num_products
+
+    def generate_signatures(self, reaction_depth=3, workers=1):
         """
         With a configured SignatureGenerator loaded with compounds and reactions, generate signatures
         and save them into the SignatureGenerator. 
 
-        Once generated, the signatures are assigned to a unique UUID and stored in the UUID map of the 
+        Once generated, the signatures are assigned their UUID and stored in the UUID map of the 
         object. 
 
+        The products are generated and grouped by formula per chunk of compounds by iter_product_groups,
+        then merged by merge_signatures. The number of merged products is kept in self.merged_count.
+
         Args:
             reaction_depth (int, optional): the maximum depth to which reactions should be permuted.. Defaults to 3.
+            workers (int, optional): number of processes generating products. Defaults to 1.
         """
         logging.info(f"generating signatures to depth {reaction_depth}")
-        reaction_depth += 1
-        products = []
-        all_rxns = self.cartesian_product_reactions(reaction_depth)
-        for cpd in tqdm.tqdm(self.compounds, position=0, leave=False, desc="Permuting Compounds:"):
-            for rxn in tqdm.tqdm(all_rxns, position=1, leave=False, desc="Permuting Reactions:"):
-                p_formula = sum_formula_dicts([parse_chemformula_dict(cpd['neutral_formula']), rxn['formula_dict']])
-                if min(p_formula.values()) > 0:
-                    products.append({
-                        "neutral_formula_mass": calculate_mass(p_formula),
-                        "neutral_formula": dict_to_hill_formula(p_formula),
-                        "reactions": rxn['reaction_name'],
-                        "uuid": str(uuid.uuid4())
-                    })
-        logging.info(f"generation produced {len(products)} signatures")
+        groups, num_products = [], 0
+        for group, group_products in self.iter_product_groups(reaction_depth, workers=workers):
+            groups.append(group)
+            num_products += group_products
+        products = self.merge_signatures(signature for group in groups for signature in group)
+        self.merged_count = num_products - len(products)
+        logging.info(f"generation produced {num_products} products, {self.merged_count} with a duplicate formula were merged into {len(products)} signatures")
         self.signatures = products
         self.uuid_map.update({p['uuid']: p for p in products})
-        
+
+    def update_signatures(self, base_signatures, reaction_depth=3, workers=1):
+        """
+        Extend a previously generated library instead of generating it anew. Compounds that are 
+        already a parent in the provenance of base_signatures are not reacted again, the others 
+        are reacted as in generate_signatures. Signature and compound UUIDs are deterministic, 
+        so a new product with the formula and mass of a base signature is added to its provenance, 
+        other products are appended after the base signatures. 
+
+        The base library must have been generated with the same reactions and reaction_depth. 
+        Libraries of earlier versions of the generator have no provenance, thus all compounds are
+        reacted again, and base signatures they reproduce get their provenance, reactions and reaction_paths.
+
+        Args:
+            base_signatures (list): the previously generated signatures
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+            workers (int, optional): number of processes generating products. Defaults to 1.
+        """
+        done = {provenance['parent'] for signature in base_signatures for provenance in signature.get('provenance', [])}
+        self.compounds = [cpd for cpd in self.compounds if cpd['uuid'] not in done]
+        logging.info(f"{len(done)} compounds found in {len(base_signatures)} base signatures, {len(self.compounds)} new compounds to react")
+        base = {(signature["neutral_formula"], signature["neutral_formula_mass"]): signature for signature in base_signatures}
+        new_signatures = []
+        if self.compounds:
+            self.generate_signatures(reaction_depth=reaction_depth, workers=workers)
+            for signature in self.signatures:
+                key = (signature["neutral_formula"], signature["neutral_formula_mass"])
+                if key in base:
+                    base[key].setdefault("provenance", []).extend(signature["provenance"])
+                    base[key].setdefault("reactions", signature["reactions"])
+                    base[key].setdefault("reaction_paths", signature["reaction_paths"])
+                    self.merged_count += 1
+                else:
+                    new_signatures.append(signature)
+        logging.info(f"added {len(new_signatures)} new signatures to {len(base_signatures)} base signatures")
+        self.signatures = list(base_signatures) + new_signatures
+        self.uuid_map.update({s['uuid']: s for s in self.signatures})
+
+    def iter_signatures(self, reaction_depth=3, shards=64, tmp_dir=None, workers=1):
+        """
+        Streaming counterpart of generate_signatures, for libraries too large to hold in memory.
+
+        Products, grouped per chunk of compounds by iter_product_groups, are appended as JSON lines to 
+        one of shards temporary files chosen by their formula, thus all duplicates of a product are in 
+        the same shard. Each shard is then merged and its signatures yielded, so memory use is one shard 
+        rather than the whole library. 
+
+        The signatures are not stored in self.signatures or the UUID map. self.merged_count is set 
+        once all signatures have been yielded.
+
+        Args:
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+            shards (int, optional): number of temporary files to partition the products into. Defaults to 64.
+            tmp_dir (str, optional): where to create the temporary files. Defaults to the system temporary directory.
+            workers (int, optional): number of processes generating products. Defaults to 1.
+
+        Yields:
+            dict: a signature
+        """
+        logging.info(f"streaming signatures to depth {reaction_depth}")
+        shard_dir = tempfile.mkdtemp(dir=tmp_dir, prefix=".signatures_")
+        try:
+            shard_paths = [os.path.join(shard_dir, f"{i}.jsonl") for i in range(shards)]
+            shard_fhs = [open(shard_path, 'w') for shard_path in shard_paths]
+            num_products, num_signatures = 0, 0
+            try:
+                for group, group_products in self.iter_product_groups(reaction_depth, workers=workers, chunked=True):
+                    num_products += group_products
+                    for signature in group:
+                        shard_fhs[zlib.crc32(signature["neutral_formula"].encode()) % shards].write(json.dumps(signature) + '\n')
+            finally:
+                for shard_fh in shard_fhs:
+                    shard_fh.close()
+            for shard_path in shard_paths:
+                with open(shard_path) as shard_fh:
+                    signatures = self.merge_signatures(json.loads(line) for line in shard_fh)
+                os.remove(shard_path)
+                num_signatures += len(signatures)
+                yield from signatures
+            self.merged_count = num_products - num_signatures
+            logging.info(f"generation produced {num_products} products, {self.merged_count} with a duplicate formula were merged into {num_signatures} signatures")
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    def stream_signatures(self, signature_path, reaction_depth=3, workers=1):
+        """
+        Generate signatures and write them to signature_path as JSON Lines, one signature per line, 
+        as they are produced, see iter_signatures.
+
+        Args:
+            signature_path (str): path to which we should save the signatures, should end in .jsonl
+            reaction_depth (int, optional): the maximum depth to which reactions should be permuted. Defaults to 3.
+            workers (int, optional): number of processes generating products. Defaults to 1.
+        """
+        logging.info(f"streaming signatures to {signature_path}")
+        tmp_dir = os.path.dirname(os.path.abspath(signature_path))
+        with open(signature_path, 'w+') as signature_path_fh:
+            for signature in self.iter_signatures(reaction_depth, tmp_dir=tmp_dir, workers=workers):
+                signature_path_fh.write(json.dumps(signature) + '\n')
+
+    def __chunk_size(self, plan):
+        """
+        Number of compounds reacted at once, so that the product count array of a chunk has at 
+        most GENERATION_CHUNK_SIZE elements.
+
+        Args:
+            plan (dict): see product_plan
+
+        Returns:
+            int: compounds per chunk
+        """
+        return max(1, self.GENERATION_CHUNK_SIZE // max(1, len(plan["reactions"]) * len(plan["elements"])))
+
+    def __pruning_plan(self, elements):
+        """
+        Convert self.pruning into arrays over the element axis for __prune.
+
+        Args:
+            elements (list): the element axis
+
+        Returns:
+            dict: the rules, empty if no product is pruned
+        """
+        plan = {k: self.pruning[k] for k in ("min_mass", "max_mass", "min_rdbe") if k in self.pruning}
+        if "max_elements" in self.pruning:
+            plan["max_counts"] = np.array([self.pruning["max_elements"].get(e, np.iinfo(np.int64).max) for e in elements], dtype=np.int64)
+        if "min_rdbe" in self.pruning:
+            plan["rdbe_weights"] = np.array([(self.VALENCES.get(e, 2) - 2) / 2 for e in elements], dtype=np.float64)
+        if "element_ratios" in self.pruning:
+            plan["carbon"] = np.array([e in ("C", "(C13)") for e in elements])
+            # an element not on the axis has a count of 0 in every product, column None
+            plan["ratios"] = [(elements.index(e) if e in elements else None, low, high) for e, (low, high) in self.pruning["element_ratios"].items()]
+        return plan
+
+    @staticmethod
+    def __prune(counts, masses, plan):
+        """
+        Args:
+            counts (np.ndarray): count matrix of the products, one per row
+            masses (np.ndarray): neutral masses of the products
+            plan (dict): see __pruning_plan
+
+        Returns:
+            np.ndarray: bool mask of the products to keep
+        """
+        keep = np.ones(masses.shape[0], dtype=bool)
+        if "min_mass" in plan:
+            keep &= masses >= plan["min_mass"]
+        if "max_mass" in plan:
+            keep &= masses <= plan["max_mass"]
+        if "max_counts" in plan:
+            keep &= np.all(counts <= plan["max_counts"], axis=1)
+        if "min_rdbe" in plan:
+            keep &= 1 + counts @ plan["rdbe_weights"] >= plan["min_rdbe"]
+        if "ratios" in plan:
+            carbon = counts[:, plan["carbon"]].sum(axis=1)
+            for column, low, high in plan["ratios"]:
+                count = counts[:, column] if column is not None else 0
+                keep &= (carbon == 0) | ((count >= low * carbon) & (count <= high * carbon))
+        return keep
+
+    @staticmethod
+    def __hill_order(elements):
+        """
+        Order elements as dict_to_hill_formula does: C, (C13), H, then the others alphabetically.
+
+        Args:
+            elements (iterable): element symbols
+
+        Returns:
+            list: elements in Hill order
+        """
+        elements = set(elements)
+        return [e for e in ('C', '(C13)', 'H') if e in elements] + sorted(elements - {'C', '(C13)', 'H'})
+
+    @staticmethod
+    def __element_count_matrix(formula_dicts, elements):
+        """
+        Convert formula dicts into a count matrix over elements, plus a mask of the elements 
+        present as keys in each dict, as a zero count is not the same as an absent element.
+
+        Args:
+            formula_dicts (list): formula dicts, {element: count}
+            elements (list): the element axis
+
+        Returns:
+            tuple: int64 counts and bool presence arrays, both len(formula_dicts) x len(elements)
+        """
+        column = {e: i for i, e in enumerate(elements)}
+        counts = np.zeros((len(formula_dicts), len(elements)), dtype=np.int64)
+        present = np.zeros((len(formula_dicts), len(elements)), dtype=bool)
+        for i, formula in enumerate(formula_dicts):
+            for e, n in formula.items():
+                counts[i, column[e]] = n
+                present[i, column[e]] = True
+        return counts, present
+
+    @staticmethod
+    def __hill_formulas(counts, elements):
+        """
+        Hill formulas for rows of an element count matrix with elements in Hill order, equal to 
+        dict_to_hill_formula of the elements with positive counts.
+
+        Args:
+            counts (np.ndarray): count matrix, one formula per row
+            elements (list): the element axis, in Hill order
+
+        Returns:
+            list: formula strings
+        """
+        formulas = np.full(counts.shape[0], '', dtype=object)
+        for e, column in zip(elements, counts.T):
+            if column.shape[0] and column.max() > 0:
+                # the element's part of the formula for each count, '' for absent elements
+                parts = np.array([''] + [e] + [e + str(n) for n in range(2, column.max() + 1)], dtype=object)
+                formulas = formulas + parts[np.maximum(column, 0)]
+        return formulas.tolist()
+
     def save_signatures(self, signature_path):
         """
-        Save the signatures in the object to specified signature path.
+        Save the signatures in the object to specified signature path. A path ending in .jsonl
+        is written as JSON Lines, one signature per line, otherwise as a JSON document.
 
         Args:
             signature_path (str): path to which we should save the signature path
@@ -197,4 +738,8 @@ class SignatureGenerator():
         assert self.signatures is not None, "cannot save null signatures"
         #assert not os.path.exists(signature_path), "will not overwrite existing signatures!"
         with open(signature_path, 'w+') as signature_path_fh:
-            json.dump({"data": self.signatures, "metadata": "generated_automatically"}, signature_path_fh, indent=4)
+            if signature_path.endswith(".jsonl"):
+                for signature in self.signatures:
+                    signature_path_fh.write(json.dumps(signature) + '\n')
+            else:
+                json.dump({"data": self.signatures, "metadata": "generated_automatically"}, signature_path_fh, indent=4)
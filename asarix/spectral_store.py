@@ -0,0 +1,226 @@
+"""
+This module implements the Asari-X spectral store, a pre-decoded copy of the
+MS1 spectra in an mzML file.
+
+Decoding an mzML file (XML parsing plus base64 and zlib decoding of every
+spectrum) is repeated each time a repository is searched. Converting each file
+once into a store allows later searches, e.g. with an updated signature library,
+to read the spectra directly from memory-mapped arrays instead.
+
+A store is a directory named <sample>.spectra_ASARIX next to <sample>.mzML with
+one .npy file per field:
+
+    offsets.npy - int64, n_scans + 1, peaks of scan i are offsets[i]:offsets[i+1]
+    mz.npy - float64, m/z of all peaks, scan by scan
+    intensity.npy - float32, intensity of all peaks, scan by scan
+    rt.npy - float64, n_scans, scan time in seconds
+    polarity.npy - int8, n_scans, 1 for positive and -1 for negative scans
+"""
+
+import os
+import shutil
+import tempfile
+import logging
+
+import multiprocessing as mp
+
+import numpy as np
+import pymzml
+import tqdm
+
+def iter_mzml_spectra(file):
+    """
+    Lazily read the MS1 spectra of an mzML file, one at a time, so that only the current
+    spectrum is held in memory. Polarity is determined for each scan.
+
+    Args:
+        file (string): path to mzml file
+
+    Yields:
+        tuple: (mode, scan_time in seconds, mz array, intensity array) for each MS1 scan
+    """
+    for spec in pymzml.run.Reader(file):
+        if spec.ms_level == 1:
+            yield 'pos' if spec['positive scan'] else 'neg', spec.scan_time_in_minutes() * 60, spec.mz, spec.i
+
+def mzml_scan_window(mzml_files):
+    """
+    The m/z range acquired in mzml_files, the union of the scan windows recorded for the first
+    MS1 spectrum of each file. Only that spectrum is read from each file.
+
+    Args:
+        mzml_files (list): paths to mzML files
+
+    Returns:
+        tuple: lowest and highest m/z, or None if a file does not record its scan window
+    """
+    window = None
+    for file in mzml_files:
+        for spec in pymzml.run.Reader(file):
+            if spec.ms_level == 1:
+                lower, upper = spec['MS:1000501'], spec['MS:1000500']
+                if lower is None or upper is None:
+                    logging.info(f"no scan window recorded in {file}")
+                    return None
+                lower, upper = float(lower), float(upper)
+                window = (min(window[0], lower), max(window[1], upper)) if window else (lower, upper)
+                break
+    return window
+
+def _convert_mzml(mzml_path):
+    """
+    Pool worker for SpectralStore.from_mzml_files. 
+
+    Args:
+        mzml_path (str): path to mzML file
+
+    Returns:
+        str: path to the new spectral store
+    """
+    return SpectralStore.from_mzml(mzml_path).path
+
+class SpectralStore():
+    """
+    Memory-mapped MS1 spectra of a single mzML file, see module docstring for the layout.
+    """
+    EXTENSION = ".spectra_ASARIX"
+    PEAK_FIELDS = {"mz": np.float64, "intensity": np.float32}
+    SCAN_FIELDS = {"rt": np.float64, "polarity": np.int8}
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        self.mz = np.load(os.path.join(path, "mz.npy"), mmap_mode=mmap_mode)
+        self.intensity = np.load(os.path.join(path, "intensity.npy"), mmap_mode=mmap_mode)
+        self.rt = np.load(os.path.join(path, "rt.npy"), mmap_mode=mmap_mode)
+        self.polarity = np.load(os.path.join(path, "polarity.npy"), mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return self.rt.shape[0]
+
+    def iter_spectra(self):
+        """
+        Iterate over the spectra in the store, same format as iter_mzml_spectra.
+
+        Yields:
+            tuple: (mode, scan_time in seconds, mz array, intensity array) for each MS1 scan
+        """
+        offsets = self.offsets.tolist()
+        for i, (rt, polarity) in enumerate(zip(self.rt.tolist(), self.polarity.tolist())):
+            yield 'pos' if polarity > 0 else 'neg', rt, self.mz[offsets[i]:offsets[i+1]], self.intensity[offsets[i]:offsets[i+1]]
+
+    @staticmethod
+    def is_store(path):
+        """
+        Args:
+            path (str): path to check
+
+        Returns:
+            bool: True if path is a spectral store
+        """
+        return path.rstrip(os.sep).endswith(SpectralStore.EXTENSION) and os.path.isdir(path)
+
+    @staticmethod
+    def store_path(mzml_path):
+        """
+        Args:
+            mzml_path (str): path to an mzML file
+
+        Returns:
+            str: the path of the store for that mzML file
+        """
+        return mzml_path.replace('.mzML', SpectralStore.EXTENSION)
+
+    @staticmethod
+    def source_path(store_path):
+        """
+        Args:
+            store_path (str): path to a spectral store
+
+        Returns:
+            str: the path of the mzML file the store was made from
+        """
+        return store_path.rstrip(os.sep).replace(SpectralStore.EXTENSION, '.mzML')
+
+    @staticmethod
+    def from_mzml(mzml_path, store_path=None):
+        """
+        Convert an mzML file into a spectral store. Spectra are streamed from the mzML file and
+        appended to the store, so memory use is one spectrum regardless of the size of the file.
+
+        The store is assembled in a temporary directory and renamed into place when complete,
+        an existing store for the file is replaced.
+
+        Args:
+            mzml_path (str): path to mzML file
+            store_path (str, optional): where to write the store. Defaults to next to the mzML file.
+
+        Returns:
+            SpectralStore: the new store
+        """
+        store_path = store_path if store_path else SpectralStore.store_path(os.path.abspath(mzml_path))
+        logging.info(f"converting {mzml_path} to spectral store {store_path}")
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(store_path)), prefix=".spectra_")
+        try:
+            offsets, scan_fields = [0], {field: [] for field in SpectralStore.SCAN_FIELDS}
+            peak_fhs = {field: open(os.path.join(tmp_dir, field + ".bin"), 'wb') for field in SpectralStore.PEAK_FIELDS}
+            try:
+                for mode, scan_time, mzs, intensities in iter_mzml_spectra(mzml_path):
+                    np.asarray(mzs, dtype=SpectralStore.PEAK_FIELDS["mz"]).tofile(peak_fhs["mz"])
+                    np.asarray(intensities, dtype=SpectralStore.PEAK_FIELDS["intensity"]).tofile(peak_fhs["intensity"])
+                    offsets.append(offsets[-1] + len(mzs))
+                    scan_fields["rt"].append(scan_time)
+                    scan_fields["polarity"].append(1 if mode == 'pos' else -1)
+            finally:
+                for fh in peak_fhs.values():
+                    fh.close()
+            for field, dtype in SpectralStore.PEAK_FIELDS.items():
+                SpectralStore.__bin_to_npy(os.path.join(tmp_dir, field), dtype, offsets[-1])
+            np.save(os.path.join(tmp_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+            for field, dtype in SpectralStore.SCAN_FIELDS.items():
+                np.save(os.path.join(tmp_dir, field + ".npy"), np.array(scan_fields[field], dtype=dtype))
+            # mkdtemp creates the directory private to the user, stores are shared like the mzML files
+            os.chmod(tmp_dir, 0o755)
+            if os.path.isdir(store_path):
+                shutil.rmtree(store_path)
+            os.rename(tmp_dir, store_path)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        return SpectralStore(store_path)
+
+    @staticmethod
+    def from_mzml_files(mzml_files, workers=1):
+        """
+        Convert each of mzml_files to a spectral store next to it, see from_mzml.
+
+        Args:
+            mzml_files (list): paths to mzML files
+            workers (int, optional): number of files to convert in parallel. Defaults to 1.
+
+        Returns:
+            list: paths to the spectral stores, in the order of mzml_files
+        """
+        if workers > 1 and len(mzml_files) > 1:
+            with mp.Pool(min(workers, len(mzml_files))) as pool:
+                return list(tqdm.tqdm(pool.imap(_convert_mzml, mzml_files), total=len(mzml_files), desc="converting mzML"))
+        return [_convert_mzml(f) for f in tqdm.tqdm(mzml_files, desc="converting mzML")]
+
+    @staticmethod
+    def __bin_to_npy(path, dtype, length):
+        """
+        Turn the raw array written to path.bin into path.npy by prepending the .npy header.
+
+        Args:
+            path (str): path to the array without extension
+            dtype (type): numpy dtype of the array
+            length (int): number of elements in the array
+        """
+        with open(path + ".npy", 'wb') as npy_fh, open(path + ".bin", 'rb') as bin_fh:
+            np.lib.format.write_array_header_1_0(npy_fh, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                'fortran_order': False,
+                'shape': (length,)
+            })
+            shutil.copyfileobj(bin_fh, npy_fh)
+        os.remove(path + ".bin")
@@ -4,6 +4,8 @@ A collection of helper functions for throughout Asari-X.
 Most importantly the consecutive scan set generation is defined here.
 """
 
+import hashlib
+import json
 from collections import defaultdict
 
 def logo():
@@ -38,6 +40,57 @@ def sum_formula_dicts(formula_dicts):
             _d[key] += wd[key]
     return _d
 
+def iter_signatures(signature_path):
+    """
+    Read a signature library from disk one signature at a time. JSON Lines files, ending
+    in .jsonl, are streamed, a JSON document is read in full first.
+
+    Args:
+        signature_path (str): path to a signatures JSON file, {"data": [...], ...}, or JSON Lines file
+
+    Yields:
+        dict: a signature
+    """
+    with open(signature_path) as signature_fh:
+        if signature_path.endswith(".jsonl"):
+            for line in signature_fh:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(signature_fh)['data']
+
+def load_signatures(signature_path):
+    """
+    Read a signature library from disk.
+
+    Args:
+        signature_path (str): path to a signatures JSON file, {"data": [...], ...}, or JSON Lines file
+
+    Returns:
+        list: the signatures
+    """
+    return list(iter_signatures(signature_path))
+
+def signature_digest(signatures, **options):
+    """
+    Compute a content hash for a list of signatures and the options used to process them. 
+    
+    Signatures are serialized with sorted keys, thus the digest does not depend on key 
+    order within a signature, but it does depend on the order of the signatures. 
+
+    Args:
+        signatures (iterable): signatures, each a JSON-serializable dict
+        **options: additional settings that change the result of processing the signatures
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    for signature in signatures:
+        digest.update(json.dumps(signature, sort_keys=True).encode())
+    return digest.hexdigest()
+
 # todo - maybe this should not be here?
 def consecutive_scans(scans, max_gap=2, min_group_size=2):
     """
@@ -72,4 +125,76 @@ def consecutive_scans(scans, max_gap=2, min_group_size=2):
                 if not gap_filled:
                     groups.append([scan])
         return [g for g in groups if len(g) >= min_group_size]
-    return []
\ No newline at end of file
+    return []
+
+class ConsecutiveScanEncoder():
+    """
+    Streaming counterpart of consecutive_scans. Hits are added in scan order, one open 
+    run is kept per key and when a run closes it is either kept, if it spans at least 
+    min_group_size scans, or dropped. Kept runs group the same scans as consecutive_scans
+    would on the full list of hits for the key.
+
+    Runs close when a later hit for the key falls beyond max_gap, when close_before is
+    called with a scan beyond max_gap of the run, or by close_all. 
+
+    Of the rows of dropped runs, only dropped_fields(row) is kept, e.g. the fields needed 
+    to filter them later like the kept rows. 
+    """
+    def __init__(self, max_gap=2, min_group_size=2, dropped_fields=lambda row: row):
+        self.max_gap = max_gap
+        self.min_group_size = min_group_size
+        self.dropped_fields = dropped_fields
+        # key: rows of the kept runs, in order of the first hit for the key
+        self.hits = {}
+        # key: dropped_fields of the rows of the dropped runs
+        self.dropped = {}
+        # key: [last scan, number of scans, rows] of the open run
+        self.__open = {}
+
+    def add(self, key, scan, row):
+        """
+        Add a hit for key. Scans must be non-decreasing across calls.
+
+        Args:
+            key (str): the key the hit belongs to, e.g. signature ion
+            scan (int): scan number of the hit
+            row (tuple): the hit
+        """
+        run = self.__open.get(key)
+        if run is None:
+            if key not in self.hits:
+                self.hits[key], self.dropped[key] = [], []
+            self.__open[key] = [scan, 1, [row]]
+        elif scan == run[0]:
+            run[2].append(row)
+        elif scan <= run[0] + 1 + self.max_gap:
+            run[0] = scan
+            run[1] += 1
+            run[2].append(row)
+        else:
+            self.__close(key, run)
+            self.__open[key] = [scan, 1, [row]]
+
+    def close_before(self, scan):
+        """
+        Close all open runs that no hit at scan or later can extend.
+
+        Args:
+            scan (int): the current scan
+        """
+        for key in [k for k, run in self.__open.items() if run[0] + 1 + self.max_gap < scan]:
+            self.__close(key, self.__open.pop(key))
+
+    def close_all(self):
+        """
+        Close all open runs, call once all hits have been added.
+        """
+        for key, run in self.__open.items():
+            self.__close(key, run)
+        self.__open = {}
+
+    def __close(self, key, run):
+        if run[1] >= self.min_group_size:
+            self.hits[key].extend(run[2])
+        else:
+            self.dropped[key].extend(self.dropped_fields(row) for row in run[2])
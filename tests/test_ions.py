@@ -0,0 +1,44 @@
+"""
+Aggregation of unresolved isotopologues, see jms.ions.aggregate_isotopologue_deltas.
+"""
+
+import pytest
+
+from jms.ions import aggregate_isotopologue_deltas, generate_ion_signature, ion_charge, isotopologue_deltas
+
+def test_ion_charge():
+    assert ion_charge('M+H[1+]') == 1
+    assert ion_charge('M+2H[2+]') == 2
+    assert ion_charge('M-H[-]') == -1
+    assert ion_charge('M-2H[2-]') == -2
+
+def test_merge_boundary_scales_with_mz_and_charge():
+    deltas = ((0, '', 0.0, .8), (1, '(C13)', 1.003355, .15), (2, '(S33)', 0.999388, .05))
+    gap = 1.003355 - 0.999388
+    mz = 300.
+    # the window is just wider, then just narrower than the gap
+    merged = aggregate_isotopologue_deltas(deltas, mz, mz / gap * .999)
+    separate = aggregate_isotopologue_deltas(deltas, mz, mz / gap * 1.001)
+    assert [x[1] for x in merged] == ['', '(C13)']
+    assert merged[1][2] == pytest.approx((1.003355 * .15 + 0.999388 * .05) / .2)
+    assert merged[1][3] == pytest.approx(.2)
+    assert [x[1] for x in separate] == ['', '(C13)', '(S33)']
+    assert len(separate) == 3
+    # a doubly charged ion of the same m/z has twice the mass, so the same resolving power merges them
+    assert len(aggregate_isotopologue_deltas(deltas, mz, mz / gap * 1.001, charge=2)) == 2
+    assert len(aggregate_isotopologue_deltas(deltas, mz, mz / gap * 1.001, charge=-2)) == 2
+
+def test_window_is_set_per_adduct():
+    formula, mw = 'C20H30O2S', 334.196652
+    deltas = {x[1]: x[2] for x in isotopologue_deltas(formula)}
+    gap = deltas['(2C13)'] - deltas['(S34)']
+    ions = {x[1].split(',')[0].split(';')[0]: x[0] for x in generate_ion_signature(mw, formula, 'pos') if x[3] == 0}
+    # between the resolving powers at which the S34 and 2C13 ions of M+H and of M+Na merge
+    resolving_power = (ions['M+H[1+]'] + ions['M+Na[1+]']) / 2 / gap
+    relations = [x[1] for x in generate_ion_signature(mw, formula, 'pos', resolving_power=resolving_power)]
+    assert any(r.startswith('M+H[1+],2C13;') for r in relations)
+    assert not any(r.startswith('M+Na[1+],2C13;') for r in relations)
+    # orders are contiguous per adduct
+    for adduct in ['M+H[1+]', 'M+Na[1+]']:
+        orders = sorted(int(r.split(';')[1]) for r in relations if r.split(',')[0].split(';')[0] == adduct)
+        assert orders == list(range(len(orders)))
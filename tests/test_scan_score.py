@@ -0,0 +1,88 @@
+"""
+Scoring a wide search with a narrower score_mz_tolerance_ppm must give the same scores as 
+searching at the narrow tolerance, see README.md.
+"""
+
+import json
+import random
+from operator import itemgetter
+
+import numpy as np
+import pytest
+
+from asarix.utils import ConsecutiveScanEncoder
+from asarix.scan_search import mzML_Searcher
+from asarix.scan_score import mzML_Search_Scorer
+
+SIGNATURES = [f"{i}_C10H12N2O$M+H[1+]{iso};{order}" for i in range(20) for order, iso in enumerate(["", ",C13"])]
+
+def synthetic_hits(seed=0, max_scan=600):
+    """
+    Hits in scan order as (signature ion, (scan, intensity, mz, time, ppm_error)), with ppm errors 
+    spread over +-10 ppm so that a 3 ppm search keeps only some of them.
+    """
+    rng = random.Random(seed)
+    hits = []
+    for scan in range(max_scan):
+        for signature in SIGNATURES:
+            if rng.random() < 0.35:
+                for _ in range(rng.choice([1, 1, 1, 2])):
+                    ppm_error = float(np.float32(rng.uniform(-10, 10)))
+                    hits.append((signature, (scan, rng.randint(1, 20000), 200 * (1 + ppm_error / 1e6), scan * .5, ppm_error)))
+    return hits
+
+def search(hits, mz_tolerance_ppm, max_scan):
+    """
+    What mzML_Searcher.search_file records for these hits at mz_tolerance_ppm.
+    """
+    runs = ConsecutiveScanEncoder(max_gap=2, min_group_size=3, dropped_fields=itemgetter(1, 2, 4))
+    for signature, row in hits:
+        if abs(row[4]) < mz_tolerance_ppm:
+            runs.add(signature, row[0], row)
+    runs.close_all()
+    return {"max_scan": max_scan, "mz_tolerance_ppm": mz_tolerance_ppm, "max_gap": 2, "min_group_size": 3, 
+            "hits": runs.hits, "dropped": runs.dropped}
+
+def save(feature_dict, path, scan_format):
+    if scan_format == "json":
+        with open(path, "w") as out_fh:
+            json.dump(feature_dict, out_fh)
+    else:
+        metadata = {k: v for k, v in feature_dict.items() if k not in {"hits", "dropped"}}
+        np.savez_compressed(path, metadata=np.array(json.dumps(metadata)), 
+                            **mzML_Searcher.hits_to_columns(feature_dict["hits"], feature_dict["dropped"]))
+
+def scores(path, scan_cutoff, mz_tolerance_ppm=None):
+    sig_dict, digested = mzML_Search_Scorer.load_scan_data(path, scan_cutoff, mz_tolerance_ppm)
+    topo_sig = mzML_Search_Scorer.topo_sort_signatures(digested)
+    return {signature: mzML_Search_Scorer.score_signature(signature, topo_sig, digested, sig_dict["max_scan"], 2.5, 
+                                                          max_gap=2, min_group_size=3) 
+            for signature in topo_sig}
+
+@pytest.mark.parametrize("scan_format", ["npz", "json"])
+@pytest.mark.parametrize("scan_cutoff", [0, 5000])
+def test_wide_search_scored_narrow_equals_narrow_search(tmp_path, scan_format, scan_cutoff):
+    max_scan = 600
+    hits = synthetic_hits(max_scan=max_scan)
+    wide, narrow = tmp_path / f"wide.scans_ASARIX.{scan_format}", tmp_path / f"narrow.scans_ASARIX.{scan_format}"
+    save(search(hits, 10, max_scan), str(wide), scan_format)
+    save(search(hits, 3, max_scan), str(narrow), scan_format)
+    expected = scores(str(narrow), scan_cutoff)
+    observed = scores(str(wide), scan_cutoff, mz_tolerance_ppm=3)
+    assert expected and observed.keys() == expected.keys()
+    fields = ["score", "scans", "freq", "integral", "mz"]
+    for signature, features in expected.items():
+        assert observed[signature].keys() == features.keys()
+        for feature, values in features.items():
+            # compared field by field, mz included
+            for field, value, observed_value in zip(fields, values, observed[signature][feature]):
+                assert observed_value == value, (signature, feature, field)
+
+def test_score_tolerance_requires_ppm_errors(tmp_path):
+    # JSON search output predating per hit ppm errors, hits are (scan, intensity, mz, time)
+    path = tmp_path / "old.scans_ASARIX.json"
+    with open(path, "w") as out_fh:
+        json.dump({"max_scan": 10, "hits": {SIGNATURES[0]: [[1, 100, 200.0, .5], [2, 120, 200.0, 1.0]]}}, out_fh)
+    assert mzML_Search_Scorer.load_scan_data(str(path), 0)[1][SIGNATURES[0]]["intensities"] == [100, 120]
+    with pytest.raises(ValueError, match="without per hit ppm errors"):
+        mzML_Search_Scorer.load_scan_data(str(path), 0, mz_tolerance_ppm=3)
@@ -0,0 +1,55 @@
+"""
+Incremental signature generation, see SignatureGenerator.update_signatures.
+"""
+
+import copy
+import json
+import os
+
+import pytest
+
+from asarix.signature_generator import SignatureGenerator
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+@pytest.fixture(scope="module")
+def compounds_reactions():
+    with open(os.path.join(DATA, "cpds", "FDA_drugs.json")) as cpd_fh:
+        compounds = json.load(cpd_fh)["data"][:40]
+    with open(os.path.join(DATA, "rxns", "hydroxylation.json")) as rxn_fh:
+        reactions = json.load(rxn_fh)["data"][:4]
+    return compounds, reactions
+
+def generate(compounds, reactions):
+    SG = SignatureGenerator.from_compounds_reactions(copy.deepcopy(compounds), reactions)
+    SG.generate_signatures(reaction_depth=2)
+    return SG.signatures
+
+def by_key(signatures):
+    return {(s["neutral_formula"], s["neutral_formula_mass"]): s for s in signatures}
+
+def test_update_matches_full_generation(compounds_reactions):
+    compounds, reactions = compounds_reactions
+    full = generate(compounds, reactions)
+    SG = SignatureGenerator.from_compounds_reactions(copy.deepcopy(compounds), reactions)
+    SG.update_signatures(generate(compounds[:30], reactions), reaction_depth=2)
+    assert len(SG.signatures) == len(full)
+    updated = by_key(SG.signatures)
+    for key, signature in by_key(full).items():
+        assert updated[key]["uuid"] == signature["uuid"]
+        assert sorted(map(json.dumps, updated[key]["provenance"])) == sorted(map(json.dumps, signature["provenance"]))
+
+def test_update_old_format_base(compounds_reactions):
+    # libraries of earlier generators have no provenance or reaction_paths
+    compounds, reactions = compounds_reactions
+    full = generate(compounds, reactions)
+    base = generate(compounds[:30], reactions)
+    for signature in base:
+        del signature["provenance"], signature["reaction_paths"]
+    SG = SignatureGenerator.from_compounds_reactions(copy.deepcopy(compounds), reactions)
+    SG.update_signatures(base, reaction_depth=2)
+    assert len(SG.signatures) == len(full)
+    updated = by_key(SG.signatures)
+    for key, signature in by_key(full).items():
+        assert updated[key]["provenance"] == signature["provenance"]
+        assert updated[key]["reaction_paths"] == signature["reaction_paths"]